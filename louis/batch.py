@@ -0,0 +1,198 @@
+"""
+Runs a sequence of remote commands as a single shell script, i.e. in one
+round trip instead of one per command.
+"""
+from __future__ import with_statement
+
+from fabric.api import run, sudo, settings, env, abort
+
+from louis import facts
+from louis import trace
+
+STEP_MARKER = 'louis-step'
+
+
+def shell_quote(text):
+    """
+    Single-quotes text for the remote shell.
+    """
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def _sudo_as(command, user):
+    # with -H, so that the command gets user's HOME (pip's cache and the
+    # like) rather than the admin's
+    with settings(sudo_prefix=env.sudo_prefix + '-H '):
+        return sudo(command, user=user)
+
+
+def run_as(user, command):
+    """
+    Runs command as user through sudo over the admin's connection to the
+    host. Logging in as user would open a second SSH connection, with a
+    handshake of its own, and user may not have a login anyway.
+    """
+    return _sudo_as(command, user)
+
+
+class RemoteScript(object):
+    """
+    Collects shell commands and ships them to the remote host as one script.
+
+    The steps run in order in the same shell, so a cd in one step applies to
+    the ones after it. Execution stops at the first step that fails (unless
+    that step was added with warn_only=True), and the exit code of every step
+    that ran is available in return_codes afterwards, and its output in
+    step_outputs. Can be used as a context manager, in which case the script
+    is executed on exit:
+
+        with RemoteScript(use_sudo=True) as script:
+            script.add('mkdir -p /srv/www')
+            script.add('chown www-data /srv/www')
+
+    use_sudo and user behave as they do for fabric's sudo() (see run_as); if
+    user is given without use_sudo, the script is run by logging in as that
+    user. Files changed through append() and sed() are dropped from the
+    host's facts.
+    """
+    def __init__(self, use_sudo=False, user=None):
+        self.use_sudo = use_sudo
+        self.user = user
+        self.steps = []
+        self.return_codes = []
+        self.step_outputs = []
+        self.changed_files = []
+        self.output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, command, warn_only=False):
+        """
+        Adds a step. A warn_only step doesn't stop the script if it fails.
+        """
+        self.steps.append((command, warn_only))
+        return self
+
+    def append(self, filename, text):
+        """
+        Like fabric.contrib.files.append: appends text (a string or a list of
+        lines) to filename, skipping lines that are already in the file.
+        """
+        if isinstance(text, basestring):
+            text = [text]
+        for line in text:
+            self.add('grep -qxF -e %s %s 2>/dev/null || '
+                     'printf "%%s\\n" %s >> %s' %
+                     (shell_quote(line), filename, shell_quote(line),
+                      filename))
+        self.changed_files.append(filename)
+        return self
+
+    def sed(self, filename, before, after, limit=''):
+        """
+        Like fabric.contrib.files.sed, minus its extra round trip to find out
+        which sed the host has: louis hosts run GNU sed.
+        """
+        for char in "/'":
+            before = before.replace(char, r'\%s' % char)
+            after = after.replace(char, r'\%s' % char)
+        for char in "()":
+            after = after.replace(char, r'\%s' % char)
+        if limit:
+            limit = r'/%s/ ' % limit
+        self.add("sed -i.bak -r -e '%ss/%s/%s/g' %s" %
+                 (limit, before, after, filename))
+        self.changed_files.append(filename)
+        return self
+
+    def render(self):
+        # each marker goes on a line of its own, even after output without a
+        # final newline; when tracing, it also says when the step ended
+        clock = trace.enabled and ' "$(date +%s.%N)"' or ''
+        fields = clock and '%s %s %s %s' or '%s %s %s'
+        marker = "printf '\\n%s\\n' %s %s \"$rc\"%s"
+        lines = []
+        if clock:
+            lines.append('rc=0; ' + marker % (fields, STEP_MARKER, 'start',
+                                              clock))
+        for i, (command, warn_only) in enumerate(self.steps):
+            lines.append(command)
+            lines.append('rc=$?; ' + marker % (fields, STEP_MARKER, i, clock))
+            if not warn_only:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines)
+
+    def execute(self):
+        """
+        Runs the script and returns the list of exit codes of the steps that
+        ran. Aborts on a failed step unless env.warn_only is set.
+        """
+        if not self.steps:
+            return []
+        script = self.render()
+        with settings(warn_only=True):
+            if self.use_sudo and self.user:
+                self.output = _sudo_as(script, self.user)
+            elif self.use_sudo:
+                self.output = sudo(script)
+            elif self.user:
+                with settings(user=self.user):
+                    self.output = run(script)
+            else:
+                self.output = run(script)
+        facts.forget_files(*self.changed_files)
+
+        self.return_codes = []
+        self.step_outputs = []
+        lines = []
+        step_start = None
+        for line in self.output.splitlines():
+            fields = line.split()
+            if len(fields) in (3, 4) and fields[0] == STEP_MARKER:
+                if lines and not lines[-1].strip():
+                    # the newline printed ahead of the marker
+                    lines.pop()
+                if fields[1] != 'start':
+                    self.return_codes.append(int(fields[2]))
+                    self.step_outputs.append('\n'.join(lines).strip())
+                    if step_start is not None and len(fields) == 4:
+                        trace.record(self.steps[int(fields[1])][0], 'step',
+                                     step_start,
+                                     float(fields[3]) - step_start,
+                                     exit_code=int(fields[2]))
+                lines = []
+                if len(fields) == 4:
+                    step_start = float(fields[3])
+            else:
+                lines.append(line)
+        failure = self._failure()
+        if failure:
+            i, rc = failure
+            message = 'Step %s of %s (%s) failed with exit code %s.' % (
+                i + 1, len(self.steps), self.steps[i][0], rc)
+            if env.warn_only:
+                print(message)
+            else:
+                abort(message)
+        return self.return_codes
+
+    def _failure(self):
+        """
+        Returns (index, exit code) of the step that stopped the script, if any.
+        """
+        for i, rc in enumerate(self.return_codes):
+            if rc and not self.steps[i][1]:
+                return i, rc
+        if len(self.return_codes) < len(self.steps):
+            # the shell went away in the middle of a step
+            return len(self.return_codes), self.output.return_code
+        return None
+
+    @property
+    def failed(self):
+        return self._failure() is not None
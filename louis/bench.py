@@ -0,0 +1,663 @@
+"""
+Benchmarks of what louis commands cost in round trips.
+
+The real commands run against a recording stand-in for the remote host:
+run, sudo, put, get, local and prompt are replaced in every louis module
+(and in fabric.contrib.files), remote commands are answered from a small
+model of the host's files, users and packages, and each one is charged a
+simulated round trip, plus a handshake the first time a user@host connection
+is used. For every benchmarked task this reports how many remote operations
+and connections it took and the simulated wall time, and compares them with
+the budgets committed in bench_budgets.json next to this file. It also
+measures what starting fab costs with a large inventory: the modules and
+tasks that importing louis.commands brings in, and how long that takes.
+With --fleet, it runs update_project on that many fake hosts with each of
+fleet's backends, with round trips that take real time, and reports how many
+hosts per second each got through and how much memory each host being worked
+on took. Those numbers depend on the machine and aren't budgeted. Last, it
+checks that with the threads backend what fabric prints for each host,
+through its own output threads, ends up with that host.
+
+
+    python -m louis.bench                  # fails if a task is over budget
+    python -m louis.bench --latency 0.2    # how it does on a slow link
+    python -m louis.bench --update         # records the current numbers
+    python -m louis.bench --hosts 10000    # startup with a bigger inventory
+    python -m louis.bench --fleet 500      # fleet backends' throughput
+
+The benchmarks use their own settings rather than the project's louisconf.
+"""
+from __future__ import with_statement
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager
+from optparse import OptionParser
+from StringIO import StringIO
+
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'bench_budgets.json')
+PATCHED = ('run', 'sudo', 'put', 'get', 'local', 'prompt')
+HOST = '10.0.0.10'
+HEAD = '0123456789abcdef0123456789abcdef01234567'
+
+TEMPLATES = {
+    'deploy/template.apache2': '<VirtualHost *:80>\n'
+                               '  ServerName %(server_name)s\n'
+                               '  WSGIDaemonProcess %(project_username)s '
+                               'processes=%(wsgi_processes)s '
+                               'threads=%(wsgi_threads)s\n'
+                               '</VirtualHost>\n',
+    'deploy/template.wsgi': 'import sys\nsys.path.insert(0, '
+                            '"%(project_dir)s")\n',
+    'deploy/template.crontab': 'MAILTO=%(cron_email)s\n',
+    'deploy/requirements.txt': 'Django\n',
+    'deploy/seed.debconf': 'postfix postfix/main_mailer_type select '
+                           'No configuration\n',
+    'deploy/admin.pub': 'ssh-rsa AAAA admin@example.com\n',
+}
+
+
+def _conf(root):
+    """
+    The settings the benchmarks run with, as a stand-in louis.conf.
+    """
+    conf = types.ModuleType('louis.conf')
+    conf.HOSTS = [(HOST, 'bench')]
+    conf.BASIC_PACKAGES = ['git-core', 'python-dev', 'python-virtualenv']
+    conf.SYSADMINS = {'admin': {'ssh_key_path':
+                                os.path.join(root, 'deploy/admin.pub'),
+                                'shell': 'bash',
+                                'email': 'admin@example.com'}}
+    conf.DEBCONF_SEEDS = [os.path.join(root, 'deploy/seed.debconf')]
+    conf.PROJECT_NAME = 'project'
+    conf.GIT_URL = 'git@example.com:project.git'
+    conf.SERVER_NAME = 'example.com'
+    return conf
+
+
+def _unquote(text):
+    return text[1:-1].replace("'\\''", "'")
+
+
+def _md5(text):
+    return hashlib.md5(text).hexdigest()
+
+
+class FakeHost(object):
+    """
+    Just enough of a host for louis's commands to take their normal path:
+    files written with printf or put read back with cat and md5sum, and
+    users, groups and packages that show up in the facts once created.
+    """
+    def __init__(self):
+        self.files = {'/etc/sudoers': '', '/etc/hosts': '', '/etc/fstab': ''}
+        self.users = set(['root', 'www-data'])
+        self.groups = set(['root', 'www-data'])
+        self.packages = set(['openssh-server'])
+
+    def execute(self, command):
+        if 'louis-step' in command:
+            return self._script(command)
+        return self._command(command.strip())
+
+    def _script(self, script):
+        output = []
+        step = []
+        for line in script.splitlines():
+            match = re.match(r"rc=\$\?; printf '.*' louis-step (\d+) ",
+                             line)
+            if match:
+                output.append(self._command('\n'.join(step).strip()))
+                output.append('louis-step %s 0' % match.group(1))
+                step = []
+            elif not line.startswith(('[ $rc', 'rc=0; printf')):
+                step.append(line)
+        return '\n'.join([o for o in output if o])
+
+    def _checksums(self, command):
+        lines = []
+        for path in re.findall(r"'([^']+)'", command.split('; do')[0]):
+            if path in self.files:
+                lines.append('%s  %s' % (_md5(self.files[path]), path))
+        return '\n'.join(lines)
+
+    def _facts(self, command):
+        sections = [
+            ('users', '\n'.join(sorted(self.users))),
+            ('groups', '\n'.join(sorted(self.groups))),
+            ('packages', '\n'.join(['%s 1.0 install ok installed' % p
+                                    for p in sorted(self.packages)])),
+            ('services', ' [ + ]  apache2\n [ + ]  postgresql'),
+            ('files', self._checksums(command.split('==louis-facts== files')
+                                      [1])),
+            ('hardware', 'memory_kb 4194304\ncpus 2\nrotational 0'),
+        ]
+        return '\n'.join(['==louis-facts== %s\n%s' % s for s in sections])
+
+    def _command(self, command):
+        match = re.match(r'^printf "%s" (\'.*\') > (\S+)$', command, re.S)
+        if match:
+            self.files[match.group(2)] = _unquote(match.group(1))
+            return ''
+        if '==louis-facts==' in command:
+            return self._facts(command)
+        if command.startswith('for f in '):
+            return self._checksums(command)
+        match = re.match(r'^cat (\S+)', command)
+        if match:
+            return self.files.get(match.group(1), '')
+        match = re.match(r'^md5sum (\S+)', command)
+        if match:
+            path = match.group(1)
+            return '%s  %s' % (_md5(self.files.get(path, path)), path)
+        if command.startswith('git rev-parse'):
+            return HEAD
+        match = re.search(r'apt-get -y install (.*)$', command)
+        if match:
+            self.packages.update([p.split('=')[0]
+                                  for p in match.group(1).split()])
+        match = re.search(r'useradd .* (\S+)$', command)
+        if match:
+            self.users.add(match.group(1))
+            self.groups.add(match.group(1))
+        match = re.match(r'^groupadd (\S+)$', command)
+        if match:
+            self.groups.add(match.group(1))
+        return ''
+
+
+class Recorder(object):
+    """
+    Stands in for fabric's remote operations, charging each one simulated
+    time: latency per round trip, handshake per new connection and transfer
+    time at bandwidth bytes per second. With sleep it takes that long, too.
+    """
+    def __init__(self, host, latency=0.05, handshake=None,
+                 bandwidth=10 * 1024 * 1024, sleep=False):
+        from fabric.api import env
+        self.env = env
+        self.host = host
+        self.latency = latency
+        if handshake is None:
+            handshake = 3 * latency
+        self.handshake = handshake
+        self.bandwidth = bandwidth
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.connections = set()
+        self.seconds = 0.0
+
+    def _round_trip(self, size=0):
+        from fabric.network import normalize
+        key = normalize(self.env.host_string)
+        seconds = self.latency + float(size) / self.bandwidth
+        if key not in self.connections:
+            self.connections.add(key)
+            seconds += self.handshake
+        self.commands += 1
+        self.seconds += seconds
+        if self.sleep:
+            time.sleep(seconds)
+
+    def _result(self, output):
+        from fabric.operations import _AttributeString
+        result = _AttributeString(output)
+        result.return_code = 0
+        result.failed = False
+        result.succeeded = True
+        return result
+
+    def run(self, command, *args, **kwargs):
+        if self.env.get('cwd'):
+            command = 'cd %s && %s' % (self.env.cwd, command)
+        output = self.host.execute(re.sub(r'^cd \S+ && ', '', command))
+        self._round_trip(len(command) + len(output))
+        return self._result(output)
+
+    def sudo(self, command, *args, **kwargs):
+        return self.run(command)
+
+    def put(self, local_path=None, remote_path=None, *args, **kwargs):
+        if hasattr(local_path, 'read'):
+            text = local_path.read()
+        else:
+            text = open(local_path).read()
+        if self.env.get('cwd') and not remote_path.startswith('/'):
+            remote_path = '%s/%s' % (self.env.cwd, remote_path)
+        self.host.files[remote_path] = text
+        self._round_trip(len(text))
+        return [remote_path]
+
+    def get(self, remote_path, local_path=None, *args, **kwargs):
+        text = self.host.files.get(remote_path, '')
+        self._round_trip(len(text))
+        return [local_path]
+
+    def local(self, command, capture=False, *args, **kwargs):
+        return self._result(command.startswith('whoami') and 'deployer' or '')
+
+    def prompt(self, *args, **kwargs):
+        return ''
+
+
+def _patch(recorder):
+    import fabric.contrib.files
+    modules = [m for name, m in sys.modules.items() if m is not None and
+               name.startswith('louis')] + [fabric.contrib.files]
+    saved = []
+    for module in modules:
+        for name in PATCHED:
+            # only fabric's own functions (or louis.trace's wrappers of
+            # them), not e.g. louis.facts.get
+            if getattr(vars(module).get(name), '__module__',
+                       '').startswith('fabric'):
+                saved.append((module, name, getattr(module, name)))
+                setattr(module, name, getattr(recorder, name))
+    return saved
+
+
+def _unpatch(saved):
+    for module, name, value in saved:
+        setattr(module, name, value)
+
+
+SCENARIOS = [
+    ('init_server', lambda commands: commands.init_server()),
+    ('setup_project', lambda commands: commands.setup_project()),
+    # a redeploy with nothing changed, which should be nearly free
+    ('update_project', lambda commands: commands.update_project()),
+]
+
+
+@contextmanager
+def _bench_env(recorder):
+    """
+    Writes the templates to a temporary project directory, installs the
+    benchmarks' louis.conf and the recorder, and yields louis.commands.
+    """
+    root = tempfile.mkdtemp(prefix='louis-bench-')
+    cwd = os.getcwd()
+    try:
+        for path, text in TEMPLATES.items():
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').write(text)
+
+        # imported before the chdir, as louis may be on a relative sys.path;
+        # and some of its modules are only imported when they're used
+        import louis
+        louis.__path__[:] = [os.path.abspath(p) for p in louis.__path__]
+        conf = _conf(root)
+        if 'louis.conf' in sys.modules:
+            # louis's modules hold on to the conf module itself
+            vars(sys.modules['louis.conf']).update(vars(conf))
+        else:
+            louis.conf = sys.modules['louis.conf'] = conf
+        import louis.commands
+        from fabric.api import settings, hide
+        os.chdir(root)
+
+        saved = _patch(recorder)
+        try:
+            with settings(hide('everything'), host_string=HOST,
+                          user='deployer', hostname='bench'):
+                yield louis.commands
+        finally:
+            _unpatch(saved)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+
+def _quietly(fxn, *args, **kwargs):
+    # the output is only shown if fxn fails
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        return fxn(*args, **kwargs)
+    except BaseException:
+        stdout.write(sys.stdout.getvalue())
+        raise
+    finally:
+        sys.stdout = stdout
+
+
+def _reset_caches():
+    from louis import facts, inventory, templates
+
+    facts._cache.clear()
+    inventory.reset()
+    templates._index = None
+    templates._renders.clear()
+
+
+def run_benchmarks(latency=0.05, handshake=None, bandwidth=10 * 1024 * 1024):
+    """
+    Runs the scenarios in order against one fake host and returns a dict of
+    task -> {'commands', 'connections', 'seconds'}.
+    """
+    recorder = Recorder(FakeHost(), latency, handshake, bandwidth)
+    results = {}
+    with _bench_env(recorder) as commands:
+        for task, scenario in SCENARIOS:
+            recorder.reset()
+            _reset_caches()
+            _quietly(scenario, commands)
+            results[task] = {'commands': recorder.commands,
+                             'connections': len(recorder.connections),
+                             'seconds': round(recorder.seconds, 3)}
+    return results
+
+
+def _memory_kb(pids):
+    """
+    Returns the proportional set size of the given processes, so that pages
+    that forked workers share are only counted once, or their RSS where the
+    kernel doesn't report PSS.
+    """
+    total = 0
+    for pid in pids:
+        for name, field in (('smaps_rollup', 'Pss:'), ('status', 'VmRSS:')):
+            try:
+                lines = open('/proc/%s/%s' % (pid, name)).readlines()
+            except IOError:
+                continue
+            values = [int(l.split()[1]) for l in lines if l.startswith(field)]
+            if values:
+                total += values[0]
+                break
+    return total
+
+
+def run_fleet_benchmark(backend, hosts=200, pool_size=50, latency=0.05):
+    """
+    Runs a no-change update_project with fleet's backend on hosts fake hosts,
+    pool_size at a time, with round trips that really take latency seconds.
+    Returns a dict with the hosts done per second and the memory each host
+    being worked on took, in KB.
+    """
+    from multiprocessing import active_children
+
+    recorder = Recorder(FakeHost(), latency, sleep=True)
+    with _bench_env(recorder) as commands:
+        from louis import conf
+        _quietly(commands.setup_project)
+        _reset_caches()
+        conf.HOSTS = [('10.1.%s.%s' % (i // 250, i % 250 + 1), 'host%s' % i)
+                      for i in range(hosts)]
+
+        baseline = _memory_kb([os.getpid()])
+        samples = [baseline]
+        running = [True]
+
+        def sample():
+            while running[0]:
+                samples.append(_memory_kb([os.getpid()] + [
+                    p.pid for p in active_children()]))
+                time.sleep(0.05)
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        start = time.time()
+        try:
+            _quietly(commands.fleet, 'update_project', pool_size=pool_size,
+                     backend=backend)
+        finally:
+            elapsed = time.time() - start
+            running[0] = False
+            sampler.join()
+    return {'hosts_per_second': round(hosts / elapsed, 1),
+            'memory_per_host_kb': (max(samples) - baseline) //
+            min(pool_size, hosts)}
+
+
+class FakeChannel(object):
+    """
+    Enough of an SSH channel for fabric's operations._execute, so that run()
+    goes through fabric's own output threads. Every command is answered with
+    lines naming the host the channel was opened for, a byte at a time; ones
+    with secret in them answer with secret lines.
+    """
+    input_enabled = False
+
+    def __init__(self, host, lines=20):
+        self.host = host
+        self.lines = lines
+        self.pending = []
+
+    def exec_command(self, command):
+        word = 'secret' in command and 'secret' or 'line'
+        self.pending = list(''.join(['%s %s %s\n' % (self.host, word, i)
+                                     for i in range(self.lines)]))
+
+    def recv(self, size):
+        if not self.pending:
+            return ''
+        byte = self.pending.pop(0)
+        if byte == '\n':
+            # let the other hosts' threads in between lines
+            time.sleep(0.001)
+        return byte
+
+    def recv_stderr(self, size):
+        return ''
+
+    def exit_status_ready(self):
+        return not self.pending
+
+    def recv_exit_status(self):
+        return 0
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def get_pty(self, *args, **kwargs):
+        pass
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def _echo_command():
+    from fabric.api import run, settings, hide
+
+    with settings(hide('stdout')):
+        run('echo secret')
+    run('echo line')
+
+
+def check_thread_output(hosts=4):
+    """
+    Runs fleet's threads backend on hosts fake hosts with run() going
+    through fabric's operations._execute, and returns a list of what's wrong
+    with the output: lines shown for the wrong host or without one, output
+    that was hidden shown anyway, and hosts whose output isn't in their
+    result.
+    """
+    import fabric.operations
+    from fabric.api import env, settings, show
+
+    host_list = [('10.2.0.%s' % (i + 1), 'host%s' % i) for i in range(hosts)]
+    names = dict(host_list)
+    saved_channel = fabric.operations.default_channel
+    fabric.operations.default_channel = lambda: FakeChannel(
+        names[env.host_string])
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    with _bench_env(Recorder(FakeHost())) as commands:
+        from louis import parallel
+        commands._echo_command = _echo_command
+        try:
+            with settings(show('everything')):
+                results = parallel.run_on_hosts('_echo_command', host_list,
+                                                pool_size=hosts,
+                                                backend='threads')
+        finally:
+            del commands._echo_command
+            printed = sys.stdout.getvalue()
+            sys.stdout = stdout
+            fabric.operations.default_channel = saved_channel
+
+    problems = []
+    for line in printed.splitlines():
+        match = re.match(r'^\[(\w+)\] \[([\d.]+)\] out: (\w+) ', line)
+        if ' out: ' in line and not (match and match.group(1) ==
+                                     names.get(match.group(2)) ==
+                                     match.group(3)):
+            problems.append('shown as: %s' % line)
+        if ' secret ' in line:
+            problems.append('hidden but shown: %s' % line)
+    for result in results:
+        if '%s line %s' % (result['name'], 19) not in result['output']:
+            problems.append("%s's output isn't in its result" %
+                            result['name'])
+        if not result['ok']:
+            problems.append('%s failed: %s' % (result['name'],
+                                               result['error']))
+    return problems
+
+
+# run in a fresh interpreter by measure_startup
+STARTUP_SCRIPT = """
+import json, sys, time, types
+sys.path.insert(0, %(path)r)
+conf = types.ModuleType('louis.conf')
+conf.HOSTS = [('10.%%d.%%d.%%d' %% (i >> 16 & 255, i >> 8 & 255, i & 255),
+               'host%%d' %% i) for i in range(%(hosts)d)]
+import louis
+louis.conf = conf
+sys.modules['louis.conf'] = conf
+from fabric.main import load_tasks_from_module
+# python 2 also records failed implicit relative imports, as None
+count = lambda: len([m for m in sys.modules.values() if m is not None])
+before = count()
+start = time.time()
+import louis.commands
+tasks = load_tasks_from_module(louis.commands)[2]
+print(json.dumps({'modules': count() - before, 'tasks': len(tasks),
+                  'seconds': round(time.time() - start, 3)}))
+"""
+
+
+def measure_startup(hosts=1000):
+    """
+    Imports louis.commands in a new python with an inventory of hosts hosts,
+    and returns a dict with the number of modules it imported, the number of
+    tasks fab finds and the seconds that took.
+    """
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT % {
+        'path': path, 'hosts': hosts}], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('Importing louis.commands failed.')
+    return dict(json.loads(output), hosts=hosts)
+
+
+def check_budgets(results, startup, budgets, link):
+    """
+    Returns a list of (task, measure, value, budget) for every measure over
+    its budget, startup's included. Simulated seconds are only compared when
+    the budgets were recorded with the same link settings, and startup only
+    with the same number of hosts.
+    """
+    over = []
+    startup_budget = budgets.get('startup', {})
+    if startup_budget.get('hosts') == startup['hosts']:
+        # wall time depends on the machine, so only the counts are budgeted
+        for measure in ('modules', 'tasks'):
+            if startup[measure] > startup_budget[measure]:
+                over.append(('startup', measure, startup[measure],
+                             startup_budget[measure]))
+    for task, measured in sorted(results.items()):
+        for measure, value in sorted(measured.items()):
+            if measure == 'seconds' and budgets.get('link') != link:
+                continue
+            budget = budgets['tasks'].get(task, {}).get(measure)
+            if budget is not None and value > budget:
+                over.append((task, measure, value, budget))
+    return over
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--latency', type='float', default=0.05,
+                      help='seconds per round trip')
+    parser.add_option('--handshake', type='float', default=None,
+                      help='seconds per new connection (3 round trips)')
+    parser.add_option('--bandwidth', type='float', default=10 * 1024 * 1024,
+                      help='bytes per second')
+    parser.add_option('--hosts', type='int', default=1000,
+                      help='inventory size to measure startup with')
+    parser.add_option('--fleet', type='int', default=0,
+                      help='number of hosts to benchmark fleet backends with')
+    parser.add_option('--pool-size', type='int', default=50,
+                      help='hosts worked on at a time with --fleet')
+    parser.add_option('--update', action='store_true',
+                      help='write the results to %s' % BUDGETS_PATH)
+    options, args = parser.parse_args(argv)
+
+    handshake = options.handshake
+    if handshake is None:
+        handshake = 3 * options.latency
+    link = {'latency': options.latency, 'handshake': round(handshake, 6),
+            'bandwidth': options.bandwidth}
+    results = run_benchmarks(link['latency'], link['handshake'],
+                             link['bandwidth'])
+    print('%-16s %9s %12s %9s' % ('task', 'commands', 'connections',
+                                  'seconds'))
+    for task, scenario in SCENARIOS:
+        print('%(task)-16s %(commands)9s %(connections)12s %(seconds)9.2f' %
+              dict(results[task], task=task))
+    startup = measure_startup(options.hosts)
+    print('Startup with %s hosts: %s modules, %s tasks, %.3fs' % (
+        options.hosts, startup['modules'], startup['tasks'],
+        startup['seconds']))
+    if options.fleet:
+        from louis.parallel import BACKENDS
+        for backend in BACKENDS:
+            fleet = run_fleet_benchmark(backend, options.fleet,
+                                        options.pool_size, options.latency)
+            print('fleet with %s on %s hosts, %s at a time: %s hosts/s, '
+                  '%sKB per host' % (backend, options.fleet, options.pool_size,
+                                     fleet['hosts_per_second'],
+                                     fleet['memory_per_host_kb']))
+
+    if options.update:
+        with open(BUDGETS_PATH, 'w') as budgets_file:
+            json.dump({'link': link, 'tasks': results,
+                       'startup': {'hosts': startup['hosts'],
+                                   'modules': startup['modules'],
+                                   'tasks': startup['tasks']}}, budgets_file,
+                      indent=4, sort_keys=True)
+            budgets_file.write('\n')
+        print('Budgets written to %s' % BUDGETS_PATH)
+        return 0
+    budgets = json.load(open(BUDGETS_PATH))
+    over = check_budgets(results, startup, budgets, link)
+    for task, measure, value, budget in over:
+        print('%s is over budget: %s %s > %s' % (task, value, measure, budget))
+    problems = check_thread_output()
+    for problem in problems:
+        print('Threads backend output: %s' % problem)
+    return (over or problems) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,26 @@
 from louis.commands.packages import *
 from louis.commands.users import *
 from louis.commands.projects import *
+from louis.commands.releases import *
 from louis.commands.databases import *
 from louis.commands.solr import *
+from louis.commands.fleet import *
+from louis.commands.tuning import *
+import hashlib
+
+from fabric.api import abort
+from fabric.colors import green
+
 from louis import conf
+from louis.utils import get_arg
+from louis import batch
+from louis import connections
+from louis import facts
+from louis import inventory
+from louis import trace as tracing
+
+
+connections.install()
 
 
 def init_server(swap_size=None, apache=True, postgres=True):
@@ -12,10 +29,18 @@ def init_server(swap_size=None, apache=True, postgres=True):
     """
     setup_swap(swap_size)
     setup_hosts()
+    config_apt_proxy()
     update()
     set_timezone()
     install_debconf_seeds()
-    install_basic_packages()
+    # resolve and install everything in one apt transaction; install_apache
+    # and install_postgres will then find their packages already installed
+    pkgs = list(conf.BASIC_PACKAGES)
+    if apache:
+        pkgs.extend(APACHE_PACKAGES)
+    if postgres:
+        pkgs.extend(POSTGRES_PACKAGES)
+    apt_install(pkgs)
     config_apticron()
     create_sysadmins()
     config_sudo()
@@ -26,18 +51,76 @@ def init_server(swap_size=None, apache=True, postgres=True):
     config_sshd()
 
 
-def setup_swap(size=None):
+def _auto_swap_size():
+    # twice the memory on small hosts, tapering off to half of it (at most
+    # 8GB) on big ones
+    memory = facts.hardware()['memory_mb']
+    if memory <= 2048:
+        return memory * 2
+    if memory <= 8192:
+        return memory
+    return min(memory // 2, 8192)
+
+
+def setup_swap(size=None, path='/swapfile', zram=None):
+    """
+    Creates a swapfile of size MB, or resizes it if it's a different size,
+    turns it on and adds it to fstab. Does nothing if all that's done already.
+
+    size defaults to louisconf.SWAP_SIZE, or else is worked out from the
+    host's memory; 0 means no swapfile. The file is preallocated with
+    fallocate, and written out in 1MB blocks where the filesystem can't swap
+    to a preallocated file.
+
+    With zram (or louisconf.SWAP_ZRAM), compressed swap in memory of zram
+    percent of the host's memory is set up as well, and used before the
+    swapfile.
     """
-    Creates swapfile and adds to fstab.  Size is in MB.
+    # not get_arg, which would take a size of 0 for no size at all
+    if size is None:
+        size = getattr(conf, 'SWAP_SIZE', None)
+    if size is None:
+        size = _auto_swap_size()
+    size = int(size)
+    zram = get_arg(zram, 'SWAP_ZRAM', None)
+    if zram:
+        setup_zram(zram)
+    if not size:
+        return
+
+    swap_bytes = size * 1024 * 1024
+    with batch.RemoteScript(use_sudo=True) as script:
+        # make a new swapfile unless there's one of the right size
+        script.add('if [ "$(stat -c %%s %s 2>/dev/null)" != "%s" ]; then '
+                   'swapoff %s 2>/dev/null; rm -f %s; '
+                   'fallocate -l %s %s && chmod 0600 %s && mkswap %s && '
+                   'swapon %s || { rm -f %s; '
+                   'dd if=/dev/zero of=%s bs=1M count=%s && chmod 0600 %s && '
+                   'mkswap %s; }; fi' %
+                   (path, swap_bytes, path, path, swap_bytes, path, path, path,
+                    path, path, path, size, path, path))
+        script.add('chown root:root %s' % path)
+        script.add('grep -q "^%s " /proc/swaps || swapon %s' % (path, path))
+        script.append('/etc/fstab', '%s swap swap defaults 0 0' % path)
+    print(green('%sMB of swap in %s.' % (size, path)))
+
+
+def setup_zram(percent=50):
     """
-    if size:
-        size = size * 1024
-        sudo('dd if=/dev/zero of=/swapfile bs=1024 count=%s' % size)
-        sudo('mkswap /swapfile')
-        sudo('chown root:root /swapfile')
-        sudo('chmod 0600 /swapfile')
-        sudo('swapon /swapfile')
-        sudo('echo \"/swapfile swap swap defaults 0 0\" >>/etc/fstab')
+    Sets up compressed swap in memory, percent of the host's memory in size,
+    with a higher priority than disk swap. Restarts zramswap only if its
+    settings changed.
+    """
+    apt_install(['zram-tools'])
+    text = 'ALGO=lz4\nPERCENT=%s\nPRIORITY=100\n' % int(percent)
+    config_path = '/etc/default/zramswap'
+    if facts.file_checksum(config_path) == hashlib.md5(text).hexdigest():
+        return
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.add('printf "%%s" %s > %s' % (batch.shell_quote(text),
+                                               config_path))
+        script.add('service zramswap restart')
+    facts.forget_files(config_path)
 
 
 def setup_hosts():
@@ -55,14 +138,40 @@ def setup_hosts():
     #import re
     #assert(re.search(r'^(\d{0,3}\.){3}\d{0,3}$', env.host) is not None)
     #files.append("%(host)s\t%(hostname)s" % env, '/etc/hosts', use_sudo=True)
-    files.append('/etc/hosts', "127.0.1.1\t%s" % env.hostname, use_sudo=True)
-    sudo("hostname %s" % env.hostname)
-    sudo('echo "%s" > /etc/hostname' % env.hostname)
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.append('/etc/hosts', "127.0.1.1\t%s" % env.hostname)
+        script.add("hostname %s" % env.hostname)
+        script.add('echo "%s" > /etc/hostname' % env.hostname)
 
 
 def set_timezone(tz_file_path='/usr/share/zoneinfo/Etc/UTC', tz_config_path='/etc/localtime'):
-    if files.exists(tz_file_path):
+    checksum = facts.file_checksum(tz_file_path)
+    if checksum and checksum != facts.file_checksum(tz_config_path):
         sudo('cp %s %s' %(tz_file_path, tz_config_path))
+        facts.forget_files(tz_config_path)
+
+
+def gather_facts():
+    """
+    Gathers users, groups, installed packages, service states and checksums of
+    managed files from the host in one go, and prints a summary. Other
+    commands do this on their own the first time they need any of it.
+    """
+    host_facts = facts.gather()
+    for kind in ('users', 'groups', 'packages', 'services'):
+        print('%s: %s' % (kind, len(host_facts[kind])))
+    for path, checksum in sorted(host_facts['files'].items()):
+        print('%s: %s' % (path, checksum or 'missing'))
+
+@tracing.untraced
+def trace():
+    """
+    Times the commands that follow and everything they run on the hosts, e.g.
+    fab trace update_project, and writes a trace file; see louis.trace.
+    Setting louisconf.TRACE does this for every command.
+    """
+    tracing.enable()
+
 
 def apache_reload():
     """
@@ -82,18 +191,52 @@ def apache_restart():
 
 
 
+def _use_host(name, ip, user=None):
+    env.hosts = [ip]
+    env.hostname = name
+    if user:
+        env.user = user
+
+
+@tracing.untraced
+def on(select, user=None):
+    """
+    Runs subsequent commands on the hosts matched by select, e.g. fab on:web1
+    update_project or fab 'on:role\\=web&dc\\=2' update_project (with the =
+    escaped, since fab splits arguments at it), one host after the other; see
+    louis.inventory.select. Takes optional user argument.
+    """
+    hosts = inventory.select(select)
+    if not hosts:
+        abort('No hosts match %s.' % select)
+    if len(hosts) == 1:
+        return _use_host(hosts[0]['name'], hosts[0]['ip'], user)
+    env.hosts = [h['ip'] for h in hosts]
+    # there's no one hostname for all of them
+    env.pop('hostname', None)
+    if user:
+        env.user = user
+
+
 def make_fxn(name, ip):
     def fxn(user=None):
-        env.hosts = [ip]
-        env.hostname = name
-        if user:
-            env.user = user
+        _use_host(name, ip, user)
     fxn.__doc__ = ("""Runs subsequent commands on %s. Takes optional user """
                   """argument.""" % name)
-    return fxn
-
-
-for ip, name in conf.HOSTS:
-    if not globals().has_key(name):
-        globals()[name] = make_fxn(name, ip)
+    return tracing.untraced(fxn)
+
+
+# a command per host is handy with a few hosts, but makes every fab run pay
+# for the whole inventory with many; use on:host then. Not get_arg, which
+# would take a limit of 0 for no limit at all
+_host_commands_limit = getattr(conf, 'HOST_COMMANDS_LIMIT', None)
+if _host_commands_limit is None:
+    _host_commands_limit = 100
+if len(conf.HOSTS) <= int(_host_commands_limit):
+    for entry in conf.HOSTS:
+        ip, name = entry[:2]
+        if name not in globals():
+            globals()[name] = make_fxn(name, ip)
 globals().pop('make_fxn')
+
+tracing.install()
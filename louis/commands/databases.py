@@ -1,18 +1,65 @@
 from __future__ import with_statement
 
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
+import hashlib
+import subprocess
+import time
+from datetime import datetime
+from StringIO import StringIO
+
+from fabric.api import (run, put, sudo, env, cd, local, prompt, settings,
+                        abort, hide)
+from fabric.colors import green
 from fabric.contrib import files
+from fabric.network import normalize
 from louis import conf
+from louis.utils import get_arg
+from louis import batch
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# the server_version_num from which pg_dump can dump in parallel
+PARALLEL_DUMP_VERSION = 90300
+
+
+def _password_hash(username, password):
+    # what postgres stores for an md5 password, and accepts in its place
+    return 'md5' + hashlib.md5(password + username).hexdigest()
+
+
+def _sql_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _sql_literal(text):
+    return "'%s'" % text.replace("'", "''")
+
+
+def _create_role_sql(username, password):
+    return ('CREATE ROLE %s PASSWORD %s NOSUPERUSER CREATEDB NOCREATEROLE '
+            'INHERIT LOGIN;' % (_sql_identifier(username),
+                                _sql_literal(_password_hash(username,
+                                                            password))))
+
+
+def _psql(sql):
+    """
+    Runs the sql statements in one psql session as the postgres user, stopping
+    at the first error. The sql is uploaded to a temporary file only the admin
+    can read and fed to psql from there, so that it never shows up in a
+    command line, where ps would show it (password hashes and all).
+    """
+    path = run('mktemp').strip()
+    put(StringIO(sql), path, mode=0600)
+    # root reads the file, and removes it whatever psql did
+    return sudo('sudo -u postgres psql -q -v ON_ERROR_STOP=1 < %s; rc=$?; '
+                'rm -f %s; exit $rc' % (path, path))
 
 
 def create_postgres_user(username, password):
     """
     Creates a plain postgres user: nosuperuser, nocreaterole, createdb.
+    Only the md5 hash of the password is sent to the server.
     """
-    psql_string = ('CREATE ROLE %s PASSWORD \'$sql_pwd\' NOSUPERUSER CREATEDB '
-                  'NOCREATEROLE INHERIT LOGIN;' % (username))
-    sudo('export sql_pwd=\'%s\'; echo "%s" | psql; export sql_pwd=""' % 
-         (password, psql_string), user='postgres', shell=True)
+    _psql(_create_role_sql(username, password))
 
 
 def delete_postgres_user(username):
@@ -35,3 +82,271 @@ def drop_postgres_db(dbname):
     Drops a postgres database.
     """
     sudo('dropdb \'%s\'' % dbname, user='postgres')
+
+
+def _parse_pairs(pairs):
+    """
+    Turns 'a:b;c:d' (as given on the command line), a dict or a list of
+    pairs into a list of pairs.
+    """
+    if not pairs:
+        return []
+    if isinstance(pairs, dict):
+        return sorted(pairs.items())
+    if isinstance(pairs, basestring):
+        return [tuple(p.split(':', 1)) for p in pairs.split(';') if p]
+    return [tuple(p) for p in pairs]
+
+
+def _parse_names(names):
+    if isinstance(names, basestring):
+        return [n for n in names.split(';') if n]
+    return list(names or [])
+
+
+def _postgres_state():
+    """
+    Returns the role name -> stored password and database name -> owner dicts
+    of the current host's cluster.
+    """
+    with settings(hide('running', 'stdout')):
+        output = sudo('psql -q -tA -F " " -c "SELECT \'role\', rolname, '
+                      'coalesce(rolpassword, \'\') FROM pg_authid UNION ALL '
+                      'SELECT \'database\', datname, pg_get_userbyid(datdba) '
+                      'FROM pg_database"', user='postgres')
+    roles, databases = {}, {}
+    for line in output.splitlines():
+        fields = line.strip().split(' ')
+        if len(fields) == 3:
+            kind, name, value = fields
+            if kind == 'role':
+                roles[name] = value
+            else:
+                databases[name] = value
+    return roles, databases
+
+
+def provision_postgres(roles=None, databases=None, drop_roles=None,
+                       drop_databases=None):
+    """
+    Makes the current host's postgres roles and databases match the given
+    ones, in one psql session.
+
+    roles is a ;-separated list of name:password (louisconf.POSTGRES_ROLES, a
+    dict or list of pairs, otherwise) and databases one of name:owner
+    (louisconf.POSTGRES_DATABASES), e.g.
+
+        fab provision_postgres:roles=shop:secret;blog:pw,databases=shop:shop
+
+    Missing roles are created like create_postgres_user does, and roles whose
+    password differs get it reset. Missing databases are created, and existing
+    ones get their owner fixed. drop_roles and drop_databases are ;-separated
+    names to drop if they exist. Existing roles and databases are read from
+    pg_authid and pg_database first, and only the statements needed are run:
+    role changes in one transaction, then the CREATE/DROP DATABASEs (which
+    can't run inside a transaction), then role drops in a second one.
+    """
+    roles = _parse_pairs(get_arg(roles, 'POSTGRES_ROLES', None))
+    databases = _parse_pairs(get_arg(databases, 'POSTGRES_DATABASES', None))
+    drop_roles = _parse_names(drop_roles)
+    drop_databases = _parse_names(drop_databases)
+
+    existing_roles, existing_databases = _postgres_state()
+    role_sql, database_sql, drop_role_sql = [], [], []
+    for name, password in roles:
+        if name not in existing_roles:
+            role_sql.append(_create_role_sql(name, password))
+        elif existing_roles[name] != _password_hash(name, password):
+            role_sql.append('ALTER ROLE %s PASSWORD %s;' % (
+                _sql_identifier(name),
+                _sql_literal(_password_hash(name, password))))
+    for name, owner in databases:
+        if name not in existing_databases:
+            database_sql.append("CREATE DATABASE %s OWNER %s ENCODING 'UTF8' "
+                                "TEMPLATE template0;" %
+                                (_sql_identifier(name), _sql_identifier(owner)))
+        elif existing_databases[name] != owner:
+            role_sql.append('ALTER DATABASE %s OWNER TO %s;' %
+                            (_sql_identifier(name), _sql_identifier(owner)))
+    for name in drop_databases:
+        if name in existing_databases:
+            database_sql.append('DROP DATABASE %s;' % _sql_identifier(name))
+    for name in drop_roles:
+        if name in existing_roles:
+            drop_role_sql.append('DROP ROLE %s;' % _sql_identifier(name))
+
+    if not (role_sql or database_sql or drop_role_sql):
+        print(green('Postgres roles and databases are up to date.'))
+        return
+    sql = []
+    if role_sql:
+        sql += ['BEGIN;'] + role_sql + ['COMMIT;']
+    sql += database_sql
+    if drop_role_sql:
+        sql += ['BEGIN;'] + drop_role_sql + ['COMMIT;']
+    for statement in sql:
+        print(statement.split(' PASSWORD ')[0])
+    _psql('\n'.join(sql))
+    print(green('Applied %s postgres changes.' %
+                len(role_sql + database_sql + drop_role_sql)))
+
+
+def _postgres_command(host, command):
+    """
+    Returns the argv that runs the shell command as the postgres user on host,
+    over ssh. host is a fabric host string, or 'local' to run the command
+    on this machine as the current user (e.g. against a local test cluster).
+    """
+    if host == 'local':
+        return ['sh', '-c', command]
+    user, hostname, port = normalize(host)
+    argv = ['ssh', '-p', port, '-o', 'BatchMode=yes']
+    key_filenames = env.key_filename or []
+    if isinstance(key_filenames, basestring):
+        key_filenames = [key_filenames]
+    for key_filename in key_filenames:
+        argv += ['-i', key_filename]
+    return argv + ['%s@%s' % (user, hostname),
+                   'sudo -n -u postgres sh -c %s' % batch.shell_quote(command)]
+
+
+def _dump_command(dbname, jobs):
+    # pg_dump only dumps in parallel to a directory, so the dump goes to a
+    # scratch directory on the database host and is tarred to stdout. -j
+    # needs 9.3; older servers are dumped by a single worker
+    return ('dir=$(mktemp -d) && jobs= && '
+            '{ [ "$(psql -d postgres -tAc "SHOW server_version_num")" '
+            '-lt %s ] || jobs="-j %s"; } && '
+            'pg_dump -Fd $jobs -f "$dir/dump" %s && '
+            'tar -C "$dir/dump" -cf - .; rc=$?; rm -rf "$dir"; exit $rc' %
+            (PARALLEL_DUMP_VERSION, jobs, batch.shell_quote(dbname)))
+
+
+def _restore_command(dbname, jobs, owner=None):
+    quoted = batch.shell_quote(dbname)
+    create = 'createdb -E UTF8 -T template0 %s' % quoted
+    restore = 'pg_restore -j %s' % jobs
+    if owner:
+        create = 'createdb -E UTF8 -T template0 -O %s %s' % (owner, quoted)
+        restore += ' --no-owner --role=%s' % owner
+    # only an existing database is cleaned first: pg_restore has no
+    # --if-exists before 9.4, so cleaning an empty one fails on every DROP
+    return ('dir=$(mktemp -d) && mkdir "$dir/dump" && '
+            'tar -C "$dir/dump" -xf - && '
+            'if psql -d postgres -tAc "SELECT 1 FROM pg_database '
+            'WHERE datname = \'%s\'" | grep -q 1; then clean=--clean; '
+            'else clean= && %s; fi && '
+            '%s $clean -d %s "$dir/dump"; rc=$?; rm -rf "$dir"; exit $rc' %
+            (dbname.replace("'", "''"), create, restore, quoted))
+
+
+def _stream(source, destination, description):
+    """
+    Copies everything read from source to destination, each of which is
+    either a file or an argv whose stdout/stdin is used, and reports the
+    throughput. Aborts if either command fails.
+    """
+    processes = []
+    if isinstance(source, list):
+        processes.append(subprocess.Popen(source, stdout=subprocess.PIPE))
+        reader = processes[-1].stdout
+    else:
+        reader = source
+    if isinstance(destination, list):
+        processes.append(subprocess.Popen(destination, stdin=subprocess.PIPE))
+        writer = processes[-1].stdin
+    else:
+        writer = destination
+
+    print(green('%s...' % description))
+    total = 0
+    start = time.time()
+    try:
+        while True:
+            chunk = reader.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            writer.write(chunk)
+            total += len(chunk)
+    except IOError as e:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        abort('%s failed: %s' % (description, e))
+    finally:
+        if isinstance(destination, list):
+            writer.close()
+    failed = [p for p in processes if p.wait()]
+    elapsed = max(time.time() - start, 0.001)
+    if failed:
+        abort('%s failed with exit code %s.' %
+              (description, failed[0].returncode))
+    print(green('%s: %.1f MB in %.1fs (%.1f MB/s)' %
+                (description, total / 1048576.0, elapsed,
+                 total / 1048576.0 / elapsed)))
+    return total, elapsed
+
+
+def backup_postgres_db(dbname, path=None, jobs=None):
+    """
+    Dumps a database of the current host (or of this machine if there's no
+    current host) into path on this machine, which defaults to
+    dbname-<timestamp>.tar.
+
+    The dump is made with pg_dump's directory format using jobs parallel
+    workers (louisconf.POSTGRES_JOBS or 4), each table compressed, and is
+    streamed back over ssh as a tar of that directory. Parallel dumps need
+    postgres 9.3 or later on the database host; older ones, such as the 9.1
+    install_postgres sets up, are dumped by a single worker.
+    """
+    jobs = int(get_arg(jobs, 'POSTGRES_JOBS', 4))
+    path = path or '%s-%s.tar' % (dbname,
+                                  datetime.now().strftime('%Y%m%d%H%M%S'))
+    host = env.host_string or 'local'
+    with open(path, 'wb') as backup:
+        _stream(_postgres_command(host, _dump_command(dbname, jobs)), backup,
+                'Backup of %s on %s to %s' % (dbname, host, path))
+    return path
+
+
+def restore_postgres_db(dbname, path, owner=None, jobs=None):
+    """
+    Restores a backup made by backup_postgres_db into a database of the
+    current host (or of this machine if there's no current host), creating
+    the database if need be and replacing the objects in it otherwise.
+
+    Runs pg_restore with jobs parallel workers (louisconf.POSTGRES_JOBS or 4),
+    which works from postgres 8.4 on. Before 9.4, replacing the objects of an
+    existing database fails on any the backup has and the database doesn't.
+    With owner, the database and everything restored into it belong to that
+    postgres user instead of the original owners.
+    """
+    jobs = int(get_arg(jobs, 'POSTGRES_JOBS', 4))
+    host = env.host_string or 'local'
+    with open(path, 'rb') as backup:
+        _stream(backup,
+                _postgres_command(host, _restore_command(dbname, jobs, owner)),
+                'Restore of %s into %s on %s' % (path, dbname, host))
+
+
+def clone_postgres_db(dbname, source, target=None, target_dbname=None,
+                      owner=None, jobs=None):
+    """
+    Copies a database from the source host into target_dbname (defaults to
+    dbname) on the target host (defaults to the current host, or this machine
+    if there's no current host), e.g. to refresh staging from production:
+
+        fab -H staging clone_postgres_db:project,source=db.example.com
+
+    The dump is streamed from one host to the other through this machine
+    without being stored on it. Dump and restore are both parallel; see
+    backup_postgres_db and restore_postgres_db.
+    """
+    jobs = int(get_arg(jobs, 'POSTGRES_JOBS', 4))
+    target = target or env.host_string or 'local'
+    target_dbname = target_dbname or dbname
+    _stream(_postgres_command(source, _dump_command(dbname, jobs)),
+            _postgres_command(target, _restore_command(target_dbname, jobs,
+                                                       owner)),
+            'Clone of %s on %s to %s on %s' % (dbname, source, target_dbname,
+                                               target))
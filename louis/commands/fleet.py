@@ -0,0 +1,198 @@
+from __future__ import with_statement
+
+import time
+from datetime import datetime
+
+from fabric.api import abort, run, settings
+from fabric.colors import green, red
+
+from louis.utils import get_arg
+import louis.commands
+from louis import inventory
+from louis import parallel
+from louis.commands.releases import _project_username
+
+
+def _select_hosts(select='all'):
+    """
+    Returns the (ip, name) pairs of the hosts matched by select, a selector
+    such as web*;db1 or role=web&dc=2; see louis.inventory.select.
+    """
+    return [(h['ip'], h['name']) for h in inventory.select(select)]
+
+
+def fleet(command, select='all', pool_size=None, user=None, backend=None,
+          timeout=None, **kwargs):
+    """
+    Runs command concurrently on every host matched by select.
+
+    select is a selector (see louis.inventory.select): a ;-separated list of
+    host names, shell-style patterns or attribute, group and tag terms joined
+    by &, and defaults to all hosts. No more than pool_size hosts (defaults to
+    conf.FLEET_POOL_SIZE or 10) are worked on at a time. Any other keyword
+    arguments are passed on to command, e.g.
+
+        fab 'fleet:update_project,select=web*;db1,branch=production'
+        fab 'fleet:update_project,select=role\\=web&dc\\=2'
+
+    (fab splits arguments at every =, so the ones in a selector need a \\.)
+
+    backend (conf.FLEET_BACKEND) is processes, a worker process per host, or
+    threads, which runs every host in this process and can work on hundreds of
+    hosts at a time; see louis.parallel. Hosts that take longer than timeout
+    seconds (conf.FLEET_TIMEOUT, no limit by default) fail.
+
+    With processes each host's output is printed in one block when that host
+    is done, with threads it's streamed line by line. Either way a per-host
+    success/failure/duration summary follows.
+    """
+    fxn = getattr(louis.commands, command, None)
+    if not callable(fxn):
+        abort('%s is not a louis command.' % command)
+    hosts = _select_hosts(select)
+    if not hosts:
+        abort('No hosts match %s.' % select)
+    pool_size = int(get_arg(pool_size, 'FLEET_POOL_SIZE', 10))
+    backend = get_arg(backend, 'FLEET_BACKEND', 'processes')
+    if backend not in parallel.BACKENDS:
+        abort('backend must be one of %s.' % ', '.join(parallel.BACKENDS))
+    timeout = get_arg(timeout, 'FLEET_TIMEOUT', None)
+
+    start = time.time()
+    results = parallel.run_on_hosts(command, hosts, kwargs, pool_size, user,
+                                    backend, timeout)
+    parallel.print_summary(command, results, time.time() - start)
+    if [r for r in results if not r['ok']]:
+        abort('%s failed on some hosts.' % command)
+    return results
+
+
+def _batches(hosts, canary, batch_size):
+    batches = []
+    if canary:
+        batches.append(hosts[:canary])
+    for i in range(canary, len(hosts), batch_size):
+        batches.append(hosts[i:i + batch_size])
+    return batches
+
+
+def _check_health(ip, name, health_url=None, health_command=None,
+                  timeout=60, server_name=None):
+    """
+    Waits up to timeout seconds for a host to pass its health check, and
+    returns whether it did.
+
+    health_url is either a path, which is requested from the host's IP with
+    server_name as the Host header (so that it hits the project's vhost), or a
+    full URL that can use %(ip)s and %(name)s. health_command is run on the
+    host and passes if it exits with 0.
+    """
+    import urllib2
+
+    deadline = time.time() + timeout
+    while True:
+        if health_command:
+            with settings(host_string=ip, warn_only=True):
+                ok = not run(health_command).failed
+        else:
+            if health_url.startswith('/'):
+                request = urllib2.Request('http://%s%s' % (ip, health_url))
+                if server_name:
+                    request.add_header('Host', server_name)
+            else:
+                request = urllib2.Request(health_url % {'ip': ip,
+                                                        'name': name})
+            try:
+                ok = urllib2.urlopen(request, timeout=10).getcode() < 400
+            except Exception as e:
+                print(red('[%s] health check: %s' % (name, e)))
+                ok = False
+        if ok or time.time() >= deadline:
+            return ok
+        time.sleep(2)
+
+
+def rolling_deploy(select='all', batch_size=None, canary=1, min_capacity=None,
+                   health_url=None, health_command=None, health_timeout=60,
+                   rollback=True, command='update_project', **kwargs):
+    """
+    Runs update_project (or command) on the hosts matched by select a batch at
+    a time, checking each batch's health before moving on to the next.
+
+    The first batch is canary hosts, and the rest are batch_size hosts
+    (louisconf.ROLLING_BATCH_SIZE or 1) at a time, but never so many that
+    fewer than min_capacity (a fraction, louisconf.ROLLING_MIN_CAPACITY or
+    0.5) of the hosts are left serving. After a batch is deployed every host
+    in it has health_timeout seconds to pass its health check: an HTTP probe
+    of health_url (louisconf.HEALTH_URL, defaults to /) or health_command
+    (louisconf.HEALTH_COMMAND); see _check_health. If a host fails to deploy
+    or to become healthy the rollout stops, and with rollback and
+    release-based deploys the failed batch is rolled back.
+
+    Other keyword arguments are passed on to command, e.g.
+
+        fab rolling_deploy:select=web*,batch_size=2,health_url=/ping/
+    """
+    hosts = _select_hosts(select)
+    if not hosts:
+        abort('No hosts match %s.' % select)
+    batch_size = int(get_arg(batch_size, 'ROLLING_BATCH_SIZE', 1))
+    canary = int(canary)
+    min_capacity = float(get_arg(min_capacity, 'ROLLING_MIN_CAPACITY', 0.5))
+    health_command = get_arg(health_command, 'HEALTH_COMMAND', None)
+    health_url = get_arg(health_url, 'HEALTH_URL', '/')
+    health_timeout = int(health_timeout)
+    server_name = get_arg(kwargs.get('apache_server_name'), 'SERVER_NAME',
+                          None)
+    if rollback in ('False', 'false', '0'):
+        rollback = False
+
+    # never take more hosts out of service than min_capacity allows
+    max_batch = max(1, int(len(hosts) * (1 - min_capacity)))
+    if batch_size > max_batch or canary > max_batch:
+        print(red('Limiting batches to %s hosts to keep %d%% capacity.' %
+                  (max_batch, min_capacity * 100)))
+        batch_size = min(batch_size, max_batch)
+        canary = min(canary, max_batch)
+
+    start = time.time()
+    results = []
+    batches = _batches(hosts, canary, batch_size)
+    for i, batch in enumerate(batches):
+        label = (i == 0 and canary) and 'canary' or 'batch %s' % i
+        print(green('Deploying %s of %s: %s' %
+                    (label, len(batches), ', '.join([n for ip, n in batch]))))
+        # releases are named after the time they're made at
+        started = datetime.now().strftime('%Y%m%d%H%M%S')
+        batch_results = parallel.run_on_hosts(command, batch, kwargs,
+                                              len(batch))
+        for result in batch_results:
+            if result['ok'] and not _check_health(result['ip'], result['name'],
+                    health_url, health_command, health_timeout, server_name):
+                result['ok'] = False
+                result['error'] = 'health check failed'
+        results.extend(batch_results)
+        failed = [r for r in batch_results if not r['ok']]
+        if failed:
+            if rollback and get_arg(kwargs.get('releases'), 'USE_RELEASES',
+                                    False):
+                print(red('Rolling back %s' % label))
+                # the user deploy_release deployed as; a host that failed
+                # may have switched releases all the same, and one that
+                # didn't is left alone by rollback_project with since
+                rollback_kwargs = {'project_username': _project_username(
+                    kwargs.get('project_username'),
+                    kwargs.get('project_name'), kwargs.get('branch')),
+                    'since': started}
+                parallel.run_on_hosts('rollback_project', batch,
+                                      rollback_kwargs, len(batch))
+                for r in batch_results:
+                    if r['ok']:
+                        r['ok'] = False
+                        r['error'] = 'rolled back'
+
+            parallel.print_summary(command, results, time.time() - start)
+            abort('Rollout stopped at %s; %s hosts were not deployed.' %
+                  (label, len(hosts) - len(results)))
+    parallel.print_summary(command, results, time.time() - start)
+    return results
@@ -1,8 +1,21 @@
 from __future__ import with_statement
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
+import os
+
+from fabric.api import run, put, get, sudo, env, cd, local, prompt, settings
 from fabric.colors import green
 from fabric.contrib import files
 from louis import conf
+from louis.utils import get_arg
+from louis import batch
+from louis import facts
+
+
+APACHE_PACKAGES = ('apache2', 'apache2-utils', 'libapache2-mod-wsgi')
+POSTGRES_PACKAGES = ('postgresql-9.1', 'python-egenix-mxdatetime')
+# what pip needs to build psycopg2; apt-get build-dep psycopg2 installs these
+# and more, so it's only run while any of them is missing
+PSYCOPG2_BUILD_PACKAGES = ('libpq-dev', 'python-dev')
+APT_ARCHIVES = '/var/cache/apt/archives'
 
 
 def update():
@@ -14,11 +27,89 @@ def update():
                     use_sudo=True)
     sudo('apt-get update -y')
     sudo('apt-get upgrade -y')
+    facts.invalidate('packages')
+
+
+def _missing_packages(pkgs):
+    """
+    Returns the packages in pkgs that aren't installed. A package given as
+    name=version only counts as installed if it's at that version.
+    """
+    installed = facts.installed_packages()
+    missing = []
+    for pkg in pkgs:
+        name, sep, version = pkg.partition('=')
+        if name not in installed or (version and installed[name] != version):
+            missing.append(pkg)
+    return missing
+
+
+def apt_install(pkgs, cache_dir=None):
+    """
+    Installs pkgs (a list or a ;-separated string) in a single apt-get
+    transaction, skipping the ones that are already installed.
+
+    If cache_dir (or louisconf.APT_CACHE_DIR) is set, it's used as a local
+    package cache shared by all hosts: the .debs it already has are uploaded
+    instead of being downloaded by the host, and the ones the host had to
+    download are added to it.
+    """
+    if isinstance(pkgs, basestring):
+        pkgs = pkgs.split(';')
+    pkgs = [p.strip() for p in pkgs if p.strip()]
+    cache_dir = get_arg(cache_dir, 'APT_CACHE_DIR', None)
+    missing = _missing_packages(pkgs)
+    if not missing:
+        print(green('Already installed: %s' % ' '.join(pkgs)))
+        return
+    print(green('Installing %s' % ' '.join(missing)))
+    if cache_dir:
+        debs = _seed_apt_archives(missing, cache_dir)
+    sudo('apt-get -y install %s' % ' '.join(missing))
+    facts.invalidate('packages')
+    if cache_dir:
+        _collect_apt_archives(debs, cache_dir)
+
+
+def _seed_apt_archives(pkgs, cache_dir):
+    """
+    Uploads the .debs needed to install pkgs that cache_dir already has and
+    returns the filenames of all of the needed .debs.
+    """
+    uris = run('apt-get -qq --print-uris install %s' % ' '.join(pkgs))
+    debs = [line.split()[1] for line in uris.splitlines()
+            if line.startswith("'") and len(line.split()) > 1]
+    for deb in debs:
+        local_deb = os.path.join(cache_dir, deb)
+        if os.path.exists(local_deb):
+            put(local_deb, '%s/%s' % (APT_ARCHIVES, deb), use_sudo=True)
+    return debs
+
+
+def _collect_apt_archives(debs, cache_dir):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for deb in debs:
+        local_deb = os.path.join(cache_dir, deb)
+        if not os.path.exists(local_deb):
+            get('%s/%s' % (APT_ARCHIVES, deb), local_deb)
+
+
+def config_apt_proxy(proxy=None):
+    """
+    Points apt at a shared package cache/proxy such as apt-cacher-ng, as
+    specified in louisconf.APT_PROXY, so that hosts don't each download the
+    same packages.
+    """
+    proxy = get_arg(proxy, 'APT_PROXY', None)
+    if not proxy:
+        return
+    sudo('echo \'Acquire::http::Proxy "%s";\' > /etc/apt/apt.conf.d/01proxy'
+         % proxy)
 
 
 def install_debconf_seeds():
-    print(green('Installing debconf-utils'))
-    sudo('apt-get -y install debconf-utils')
+    apt_install(['debconf-utils'])
     for seed_file in conf.DEBCONF_SEEDS:
         directory, sep, seed_filename = seed_file.rpartition('/')
         print(green('Installing seed: %s' % seed_filename))
@@ -30,9 +121,7 @@ def install_basic_packages():
     """
     Installs basic packages as specified in louisconf.BASIC_PACKAGES
     """
-    for pkg in conf.BASIC_PACKAGES:
-        print(green('Installing %s' % pkg))
-        sudo('apt-get -y install ' + pkg, shell=False)
+    apt_install(conf.BASIC_PACKAGES)
 
 
 def config_apticron():
@@ -40,54 +129,53 @@ def config_apticron():
     Adds sysadmin emails to the apticron config.
     """
     emails = ' '.join(v['email'] for k,v in conf.SYSADMINS.items())
-    files.sed('/etc/apticron/apticron.conf', '"root"', '"%s"' % emails, 
-              limit="EMAIL=", use_sudo=True)
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.sed('/etc/apticron/apticron.conf', '"root"', '"%s"' % emails,
+                   limit="EMAIL=")
 
 
 def config_sshd():
     """Disables password-based and root logins. Make sure that you have some
     users created with ssh keys before running this."""
     sshd_config = '/etc/ssh/sshd_config'
-    files.sed(sshd_config, 'yes', 'no', limit='PermitRootLogin', use_sudo=True)
-    files.sed(sshd_config, '#PasswordAuthentication yes', 
-              'PasswordAuthentication no', use_sudo=True)
-    sudo('/etc/init.d/ssh restart')
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.sed(sshd_config, 'yes', 'no', limit='PermitRootLogin')
+        script.sed(sshd_config, '#PasswordAuthentication yes',
+                   'PasswordAuthentication no')
+        script.add('/etc/init.d/ssh restart')
 
 
 def install_apache():
     """
     Installs apache2, mod-wsgi, and mod-ssl.
     """
-    pkgs = ('apache2', 'apache2-utils', 'libapache2-mod-wsgi', )
-    for pkg in pkgs:
-        sudo('apt-get -y install %s' % pkg)
-    sudo('virtualenv --no-site-packages /var/www/virtualenv')
-    sudo('echo ServerName $HOSTNAME > /etc/apache2/conf.d/fqdn')
-    sudo('echo "WSGIPythonHome /var/www/virtualenv" >> '
-         '/etc/apache2/conf.d/wsgi-virtualenv')
-    sudo('a2enmod ssl')
-    files.append('ServerName localhost', '/etc/apache2/httpd.conf',
-                 use_sudo=True)
-    sudo('/etc/init.d/apache2 reload')
+    apt_install(APACHE_PACKAGES)
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.add('virtualenv --no-site-packages /var/www/virtualenv')
+        script.add('echo ServerName $HOSTNAME > /etc/apache2/conf.d/fqdn')
+        script.add('echo "WSGIPythonHome /var/www/virtualenv" >> '
+                   '/etc/apache2/conf.d/wsgi-virtualenv')
+        script.add('a2enmod ssl')
+        script.append('/etc/apache2/httpd.conf', 'ServerName localhost')
+        script.add('/etc/init.d/apache2 reload')
 
 
 def install_postgres():
     """
-    Installs postgres and python mxdatetime.
+    Installs postgres and python mxdatetime, and the build dependencies of
+    psycopg2 unless they're installed already.
     """
-    pkgs = ('postgresql-9.1', 'python-egenix-mxdatetime')
-    for pkg in pkgs:
-        sudo('apt-get -y install %s' % pkg)
-    sudo('apt-get -y build-dep psycopg2')
-    
+    apt_install(POSTGRES_PACKAGES)
+    if _missing_packages(PSYCOPG2_BUILD_PACKAGES):
+        sudo('apt-get -y build-dep psycopg2')
+        facts.invalidate('packages')
+
 
 def install_collectd():
     """
     Installs collectd and configures plugins and thresholds
     """
-    pkgs = ('collectd')
-    for pkg in pkgs:
-        sudo('apt-get -y install %s' % pkg)
+    apt_install(['collectd'])
     collectd_config = '/etc/collectd/collectd.conf'
     collectd_thresholds = '/etc/collectd/thresholds.conf'
     files.sed(collectd_config, '', '', limit='', user_sudo=True)
@@ -97,7 +185,6 @@ def patch_virtualenv(user, package_path, virtualenv_path='env'):
     """
     Symlinks package_path in virtual env's site-packages.
     """
-    with settings(user=user):
-        target = ('/home/%s/%s/lib/python2.6/site-packages/' % 
-                  (user, virtualenv_path))
-        run('ln -s %s %s' % (package_path, target))
+    target = ('/home/%s/%s/lib/python2.6/site-packages/' % 
+              (user, virtualenv_path))
+    batch.run_as(user, 'ln -s %s %s' % (package_path, target))
@@ -1,17 +1,22 @@
 from __future__ import with_statement
 
+import fcntl
+import hashlib
+import os
 from datetime import datetime
 
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
-from fabric.contrib import files
+from fabric.api import run, put, get, sudo, env, cd, local, prompt, settings
 from fabric.colors import green, red
 
-import pip
-
 from louis import conf
 from louis.utils import get_arg
+from louis import batch
+from louis import facts
+from louis import inventory
+from louis import templates
 import louis.commands
 from louis.commands.users import add_ssh_keys
+from louis.commands.tuning import _wsgi_settings
 
 
 def setup_project_user(project_username=None):
@@ -21,27 +26,31 @@ def setup_project_user(project_username=None):
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
                                'project-user')
 
-    with settings(warn_only=True):
-        check_user = sudo('grep -e "%s:" /etc/passwd' % project_username)
-    if not check_user.failed:
+    if facts.user_exists(project_username):
         return
-    sudo('adduser --gecos %s --disabled-password %s' % ((project_username,)*2))
-    sudo('usermod -a -G www-data %s' % project_username)
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.add('adduser --gecos %s --disabled-password %s' %
+                   ((project_username,)*2))
+        script.add('usermod -a -G www-data %s' % project_username)
+    facts.invalidate('users')
     for u, s in conf.SYSADMINS.items():
         add_ssh_keys(target_username=project_username,
                      ssh_key_path=s['ssh_key_path'])
-    with settings(user=project_username):
-        run('mkdir -p .ssh')
-        run('ssh-keygen -t rsa -f .ssh/id_rsa -N ""')
+    # sudo to the project user rather than logging in as them, so that this
+    # doesn't need a connection of its own
+    with batch.RemoteScript(use_sudo=True, user=project_username) as script:
+        script.add('cd /home/%s' % project_username)
+        script.add('mkdir -p .ssh')
+        script.add('ssh-keygen -t rsa -f .ssh/id_rsa -N ""')
         # so that we don't get a yes/no prompt when checking out repos via ssh
-        files.append('.ssh/config', ['Host *', 'StrictHostKeyChecking no'])
-        run('mkdir -p log')
-        run('chmod 770 log')
-        run('chown %s:www-data log' % project_username)
-        run('touch log/app.log')
-        run('touch log/db.log')
-        run('chmod 664 log/*.log')
-        run('chown %s:www-data log/*.log' % project_username)
+        script.append('.ssh/config', ['Host *', 'StrictHostKeyChecking no'])
+        script.add('mkdir -p log')
+        script.add('chmod 770 log')
+        script.add('chown %s:www-data log' % project_username)
+        script.add('touch log/app.log')
+        script.add('touch log/db.log')
+        script.add('chmod 664 log/*.log')
+        script.add('chown %s:www-data log/*.log' % project_username)
 
 
 def setup_project_virtualenv(project_username=None, target_directory=None,
@@ -56,18 +65,21 @@ def setup_project_virtualenv(project_username=None, target_directory=None,
     target_directory = get_arg(target_directory, 'TARGET_DIRECTORY', 'env')
     site_packages = get_arg(site_packages, 'SITE_PACKAGES', False)
 
-    with settings(user=project_username):
-        with cd('/home/%s' % project_username):
+    with cd('/home/%s' % project_username):
+        with batch.RemoteScript(use_sudo=True,
+                                user=project_username) as script:
             if site_packages:
-                run('virtualenv %s' % target_directory)
+                script.add('virtualenv %s' % target_directory)
             else:
-                 run('virtualenv --no-site-packages %s' % target_directory)
-            run('env/bin/easy_install -U setuptools')
-            run('env/bin/easy_install pip')
+                script.add('virtualenv --no-site-packages %s' %
+                           target_directory)
+            script.add('env/bin/easy_install -U setuptools')
+            script.add('env/bin/easy_install pip')
 
 
 def install_project_requirements(project_username=None, requirements_path=None,
-                                 env_path=None, update_packages=False):
+                                 env_path=None, update_packages=False,
+                                 use_wheelhouse=None):
     """
     Installs a requirements file via pip.
 
@@ -78,71 +90,275 @@ def install_project_requirements(project_username=None, requirements_path=None,
 
     If update_packages is True, the packages already installed are updated if
     if necessary.
+
+    If use_wheelhouse (or louisconf.USE_WHEELHOUSE) is True, the requirements
+    are installed offline from a wheelhouse built once by the deployer (see
+    build_wheelhouse) instead of being downloaded and compiled on the host.
+    That needs the local copy of the requirements file to match the host's.
     """
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
                                'project-user')
     requirements_path = get_arg(requirements_path, 'REQUIREMENTS_PATH',
                                 'deploy/requirements.txt')
     env_path = get_arg(env_path, 'ENV_PATH', 'env')
+    use_wheelhouse = get_arg(use_wheelhouse, 'USE_WHEELHOUSE', False)
+
+    if use_wheelhouse:
+        remote_path = os.path.join('/home/%s' % project_username,
+                                   requirements_path)
+        digest = _wheelhouse_digest()
+        # both in one lookup; push_wheelhouse gets its answer from here
+        checksums = facts.file_checksums(
+            remote_path, '/home/%s/wheelhouse/%s' % (project_username, digest))
+        if checksums[remote_path] == digest:
+            wheelhouse = push_wheelhouse(project_username)
+            with cd('/home/%s' % project_username):
+                batch.run_as(project_username,
+                             '%s/bin/pip install --no-index --find-links=%s '
+                             '-r %s' % (env_path, wheelhouse,
+                                        requirements_path))
+            return
+        print(red('The local requirements file differs from %s, not using '
+                  'the wheelhouse.' % remote_path))
+
+    with cd('/home/%s' % project_username):
+        if update_packages:
+            batch.run_as(project_username,
+                         '%s/bin/pip install --update -M -r %s' % \
+                         (env_path, requirements_path))
+        else:
+            batch.run_as(project_username, '%s/bin/pip install -M -r %s' %
+                         (env_path, requirements_path))
+
+def _wheelhouse_digest(requirements_path=None):
+    requirements_path = get_arg(requirements_path, 'LOCAL_REQUIREMENTS_PATH',
+                                'deploy/requirements.txt')
+    return hashlib.md5(open(requirements_path).read()).hexdigest()
+
+
+def build_wheelhouse(requirements_path=None, wheelhouse_dir=None,
+                     build_host=None):
+    """
+    Builds wheels of everything in the local requirements file and returns the
+    path of a tarball of them, named after the requirements file's hash. An
+    existing tarball for the same hash is reused.
+
+    requirements_path defaults to louisconf.LOCAL_REQUIREMENTS_PATH or
+    deploy/requirements.txt, and wheelhouse_dir to louisconf.WHEELHOUSE_DIR or
+    wheelhouse. The wheels are built by the deployer, or on build_host (or
+    louisconf.WHEELHOUSE_BUILD_HOST) if given, which should match the
+    platform of the servers.
+    """
+    requirements_path = get_arg(requirements_path, 'LOCAL_REQUIREMENTS_PATH',
+                                'deploy/requirements.txt')
+    wheelhouse_dir = get_arg(wheelhouse_dir, 'WHEELHOUSE_DIR', 'wheelhouse')
+    build_host = get_arg(build_host, 'WHEELHOUSE_BUILD_HOST', None)
+    digest = _wheelhouse_digest(requirements_path)
+    tarball = os.path.join(wheelhouse_dir, '%s.tar.gz' % digest)
+
+    if not os.path.isdir(wheelhouse_dir):
+        os.makedirs(wheelhouse_dir)
+    # parallel deploys share the wheelhouse; only one of them builds it
+    lock = open(os.path.join(wheelhouse_dir, '.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        if os.path.exists(tarball):
+            return tarball
+        print(green('Building wheelhouse %s' % digest))
+        if build_host:
+            build_dir = '/tmp/wheelhouse-%s' % digest
+            with settings(host_string=build_host):
+                run('mkdir -p %s/wheels' % build_dir)
+                put(requirements_path, '%s/requirements.txt' % build_dir)
+                with cd(build_dir):
+                    run('pip wheel -w wheels -r requirements.txt && '
+                        'tar czf wheels.tar.gz -C wheels .')
+                get('%s/wheels.tar.gz' % build_dir, tarball + '.tmp')
+                run('rm -rf %s' % build_dir)
+        else:
+            build_dir = os.path.join(wheelhouse_dir, digest)
+            local('pip wheel -w %s -r %s && tar czf %s.tmp -C %s .' %
+                  (build_dir, requirements_path, tarball, build_dir))
+            local('rm -rf %s' % build_dir)
+        os.rename(tarball + '.tmp', tarball)
+        return tarball
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def push_wheelhouse(project_username=None, requirements_path=None):
+    """
+    Makes sure the wheelhouse for the local requirements file is on the host,
+    building it first if need be, and returns its remote path. It's sent as a
+    single tarball, and not at all if the host already has it.
+    """
+    project_username = get_arg(project_username, 'PROJECT_USERNAME',
+                               'project-user')
+    digest = _wheelhouse_digest(requirements_path)
+    wheelhouse = '/home/%s/wheelhouse/%s' % (project_username, digest)
+    if facts.file_exists(wheelhouse):
+        return wheelhouse
+    tarball = build_wheelhouse(requirements_path)
+    remote_tarball = '/home/%s/wheelhouse-%s.tar.gz' % (project_username,
+                                                        digest)
+    put(tarball, remote_tarball, use_sudo=True)
+    batch.run_as(project_username, 'mkdir -p %s && tar xzf %s -C %s && rm %s' %
+                 (wheelhouse, remote_tarball, wheelhouse, remote_tarball))
+    facts.forget_files(wheelhouse)
+    return wheelhouse
 
-    with settings(user=project_username):
-        with cd('/home/%s' % project_username):
-            if update_packages:
-                run('%s/bin/pip install --update -M -r %s' % \
-                    (env_path, requirements_path))
-            else:
-                run('%s/bin/pip install -M -r %s' % (env_path, requirements_path))
 
 def setup_project_code(git_url, project_name=None, project_username=None,
-                       branch=None):
+                       branch=None, ship_code=None):
     """
     Check out the project's code into its home directory. Target directory will
     be relative to project_username's home directory. target directory defaults
     to the value of project_username ie you'll end up with the code in
     /home/project/project/
+
+    With ship_code (or louisconf.SHIP_CODE), the repo is sent from the
+    deployer's clone as a git bundle instead of being cloned from git_url,
+    which is still set as the origin.
     """
     project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
     branch = get_arg(branch, 'BRANCH', 'master')
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
                                '%s-%s' % (project_name, branch))
     git_url = get_arg(git_url, 'GIT_URL', None)
+    ship_code = get_arg(ship_code, 'SHIP_CODE', False)
 
+    project_dir = '/home/%s/%s' % (project_username, project_name)
+    if facts.file_exists(project_dir):
+        print(red('Destination path already exists ie the repo has '
+                  'cloned already.'))
+        return
+    if ship_code:
+        bundle = _git_bundle(['--remotes=origin'])
+        remote_bundle = '/home/%s/%s.bundle' % (project_username, project_name)
+        put(bundle, remote_bundle, use_sudo=True)
     with cd('/home/%s' % project_username):
-        with settings(user=project_username):
-            if files.exists(project_name):
-                print(red('Destination path already exists ie the repo has '
-                          'cloned already.'))
-                return
-            run('git clone %s %s' % (git_url, project_name))
-            with cd('%s' % project_name):
-                #run('git submodule update --init') # --recursive')
-                run('git submodule init')
-                run('git submodule update')
-                # checkout and update all remote branches, so that the
-                # deployment can be any one of them
-                branches = run('git branch -r').split('\n')
-                for b in branches:
-                    if 'master' in b or 'HEAD' in b:
-                        # all remote branches except HEAD and master since those
-                        # by default
-                        continue
-                    r, sep, branch_name = b.strip().rpartition('/')
-                    run('git branch %s --track origin/%s' %
-                        (branch_name, branch_name))
-                run('git checkout %s' % branch)
+        with batch.RemoteScript(use_sudo=True,
+                                user=project_username) as script:
+            if ship_code:
+                script.add('git init -q %s' % project_name)
+                script.add('cd %s' % project_name)
+                script.add("git fetch -q %s "
+                           "'refs/remotes/origin/*:refs/remotes/origin/*'"
+                           % remote_bundle)
+                script.add('git remote add origin %s' % git_url)
+                script.add('rm %s' % remote_bundle)
+            else:
+                script.add('git clone %s %s' % (git_url, project_name))
+                script.add('cd %s' % project_name)
+            #script.add('git submodule update --init') # --recursive')
+            script.add('git submodule init')
+            script.add('git submodule update')
+            # checkout and update all remote branches, so that the
+            # deployment can be any one of them. all remote branches
+            # except HEAD and master since those are there by default
+            script.add(_track_branches_command())
+            script.add('git checkout %s' % branch)
+    facts.forget_files(project_dir)
+
+
+def _git_bundle(revs, base=None):
+    """
+    Builds a bundle of the given revs of the deployer's repo, holding only
+    the commits that aren't in base if it's given and known locally, and
+    returns its path. Bundles are kept in louisconf.SHIP_BUNDLE_DIR (or
+    .louis-bundles) and reused by every host that needs the same one.
+    """
+    bundle_dir = get_arg(None, 'SHIP_BUNDLE_DIR', '.louis-bundles')
+    if base:
+        with settings(warn_only=True):
+            if local('git cat-file -e %s^{commit}' % base).failed:
+                base = None
+    tips = local('git rev-parse %s' % ' '.join(revs), capture=True)
+    name = hashlib.md5('%s %s' % (base, tips)).hexdigest()
+    bundle = os.path.join(bundle_dir, '%s.bundle' % name)
+
+    if not os.path.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+    lock = open(os.path.join(bundle_dir, '.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        if not os.path.exists(bundle):
+            if base:
+                revs = ['^%s' % base] + revs
+            local('git bundle create %s.tmp %s' % (bundle, ' '.join(revs)))
+            os.rename(bundle + '.tmp', bundle)
+        return bundle
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+def ship_project_code(project_name=None, project_username=None, branch=None):
+    """
+    Brings origin/branch in the host's checkout up to date from the deployer's
+    clone of the repo rather than from the git server, by sending it a bundle
+    of just the commits it doesn't have yet. The deployer's clone should have
+    been fetched beforehand; what it has as origin/branch is what's shipped.
+    """
+    project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
+    branch = get_arg(branch, 'BRANCH', 'master')
+    project_username = get_arg(project_username, 'PROJECT_USERNAME',
+                               '%s-%s' % (project_name, branch))
+
+    ref = 'refs/remotes/origin/%s' % branch
+    project_dir = '/home/%s/%s' % (project_username, project_name)
+    with settings(warn_only=True):
+        with cd(project_dir):
+            remote_tip = batch.run_as(project_username,
+                                      'git rev-parse -q --verify %s' % ref)
+    if remote_tip == local('git rev-parse %s' % ref, capture=True):
+        print(green('origin/%s is up to date.' % branch))
+        return
+    bundle = _git_bundle([ref], base=remote_tip)
+    remote_bundle = '/home/%s/%s.bundle' % (project_username, project_name)
+    put(bundle, remote_bundle, use_sudo=True)
+    with cd(project_dir):
+        batch.run_as(project_username, 'git fetch -q %s +%s:%s && rm %s' %
+                     (remote_bundle, ref, ref, remote_bundle))
+
+
+def _pull_command(branch, ship_code):
+    """
+    What update_project runs instead of a git pull when the code is shipped.
+    """
+    if ship_code:
+        return 'git merge -q origin/%s' % branch
+    return 'git pull'
+
+
+def _track_branches_command():
+    """
+    Returns a shell command that creates a local tracking branch for every
+    branch of origin other than master and HEAD, in one go.
+    """
+    return ("git for-each-ref --format='%(refname)' refs/remotes/origin | "
+            "sed -e 's#^refs/remotes/origin/##' | "
+            "grep -v -x -e master -e HEAD | "
+            "while read b; do git branch --track \"$b\" \"origin/$b\"; done")
 
 
 def setup_project_apache(project_name=None, project_username=None,
                          server_name=None, server_alias=None, admin_email=None,
                          settings_module=None, media_directory=None,
-                         branch=None, git_head=None):
+                         branch=None, git_head=None, deploy_state=None,
+                         project_dir=None, env_dir=None):
     """
     Configure apache-related settings for the project.
 
     This will render every  *.apache2 file in the current local directory as a
-    template with project_name, project_username, branch, server_name and
-    server_alias as context. It'll put the rendered template in apache
-    sites-available.
+    template with project_name, project_username, branch, server_name,
+    server_alias, project_dir, env_dir, wsgi_processes and wsgi_threads as
+    context. It'll put the rendered template in apache sites-available.
+    wsgi_processes and wsgi_threads are sized for the host's hardware, see
+    louis.commands.tuning. wsgi_import_script is a WSGIImportScript line that
+    makes mod_wsgi load the application as soon as a daemon process starts,
+    for templates whose WSGIDaemonProcess is named after project_username.
 
     It will also render any *.wsgi file with the same context. It will put the
     rendered file in the project user's home directory.
@@ -150,6 +366,12 @@ def setup_project_apache(project_name=None, project_username=None,
     media_directory should be relative to the project user's home directory. It
     defaults to project_username/media ie you'd end up with
     /home/project/project/media/
+
+    project_dir and env_dir are the absolute paths the code and virtualenv
+    are served from, /home/project/project and /home/project/env by default.
+
+    deploy_state is used by update_project: if it's given, nothing is uploaded
+    or reloaded unless the rendered files differ from the last deploy.
     """
     project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
     branch = get_arg(branch, 'BRANCH', 'master')
@@ -164,11 +386,16 @@ def setup_project_apache(project_name=None, project_username=None,
     settings_module = get_arg(settings_module, 'SETTINGS_MODULE', 'settings')
     media_directory = get_arg(media_directory, 'MEDIA_DIRECTORY',
                               '%s/media/' % project_name)
+    project_dir = project_dir or '/home/%s/%s' % (project_username,
+                                                  project_name)
+    env_dir = env_dir or '/home/%s/env' % project_username
 
     # permissions for media/
-    sudo('chgrp www-data -R /home/%s/%s' %
-         (project_username, media_directory))
-    sudo('chmod g+w /home/%s/%s' % (project_username, media_directory))
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.add('chgrp www-data -R /home/%s/%s' %
+                   (project_username, media_directory))
+        script.add('chmod g+w /home/%s/%s' %
+                   (project_username, media_directory))
 
     context = {
         'project_name': project_name,
@@ -179,42 +406,72 @@ def setup_project_apache(project_name=None, project_username=None,
         'settings_module': settings_module,
         'branch': branch,
         'git_head': git_head,
+        'project_dir': project_dir,
+        'env_dir': env_dir,
     }
-    # apache config
-    apache_template = local('find . -name "template.apache2"',
-                            capture=True).strip()
+    context['wsgi_processes'], context['wsgi_threads'] = _wsgi_settings()
+    dest_path = '/home/%s/%s.wsgi' % (project_username, project_username)
+    context['wsgi_import_script'] = (
+        'WSGIImportScript %s process-group=%s application-group=%%{GLOBAL}' %
+        (dest_path, project_username))
+    digest = _digest(templates.render('template.apache2', context),
+                     templates.render('template.wsgi', context))
+    if deploy_state is not None and deploy_state.get('apache') == digest:
+        print(green('Apache and wsgi files unchanged, skipping.'))
+        return
+
     apache_filename = '%s.apache2' % project_username
-    dest_path = '/etc/apache2/sites-available/%s' % apache_filename
-    files.upload_template(apache_template, dest_path, context=context,
-                          use_sudo=True)
-    with settings(warn_only=True):
-        sudo('a2ensite %s' % apache_filename)
-
-    # wsgi file
-    wsgi_template = local('find . -name "template.wsgi"', capture=True).strip()
-    wsgi_filename = '%s.wsgi' % project_username
-    dest_path = '/home/%s/%s' % (project_username, wsgi_filename)
-    files.upload_template(wsgi_template, dest_path, use_sudo=True,
-                          context=context)
-    sudo('chown %s:%s %s' % (project_username, 'www-data', dest_path))
-    sudo('chmod 755 %s' % dest_path)
-    with settings(warn_only=True):
-        sudo('a2enmod rewrite')
-        sudo('a2enmod headers')
-    with settings(warn_only=True):
-        check_config = sudo('apache2ctl configtest')
-    if check_config.failed:
+    apache_path = '/etc/apache2/sites-available/%s' % apache_filename
+    facts.file_checksums(apache_path, dest_path)
+    changed = templates.upload('template.apache2', apache_path, context,
+                               use_sudo=True)
+    changed = templates.upload('template.wsgi', dest_path, context,
+                               use_sudo=True) or changed
+    if not changed:
+        print(green('Apache and wsgi files are up to date on the host.'))
+        if deploy_state is not None:
+            deploy_state['apache'] = digest
+        return
+
+    script = batch.RemoteScript(use_sudo=True)
+    script.add('a2ensite %s' % apache_filename, warn_only=True)
+    script.add('chown %s:%s %s' % (project_username, 'www-data', dest_path))
+    script.add('chmod 755 %s' % dest_path)
+    script.add('a2enmod rewrite', warn_only=True)
+    script.add('a2enmod headers', warn_only=True)
+    script.add('apache2ctl configtest', warn_only=True)
+    script.execute()
+    if script.return_codes[-1]:
         print(red('Invalid apache configuration! The requested configuration '
                   'was installed, but there is a problem with it.'))
     else:
         louis.commands.apache_reload()
+        if deploy_state is not None:
+            deploy_state['apache'] = digest
 
 
 def setup_project_crontab(project_name=None, project_username=None,
-                          settings_module=None, cron_email=None, install=None):
+                          settings_module=None, cron_email=None, install=None,
+                          deploy_state=None, project_dir=None, cron_hosts=None):
     """
     Install crontab under project_username
+
+    project_dir is passed on to the template as the absolute path of the code
+    the jobs should run, and defaults to /home/project_username/project_name.
+
+    The rendered crontab is spread out for the current host (see louis.cron):
+    H fields and @spread delays are picked from a hash of the host and
+    project_username, and each @singleton job runs on only one of the hosts
+    cron_hosts selects (louisconf.CRON_HOSTS, an inventory selector such as
+    role=web). There's no default for it: a crontab with @singleton jobs
+    can't be installed without it, since all the hosts would include ones the
+    project isn't deployed to.
+
+    deploy_state is used by update_project: if it's given, the crontab is only
+    uploaded if it differs from the last deploy.
     """
+    from louis import cron
+
     project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
                                '%s-master' % project_name)
@@ -222,23 +479,55 @@ def setup_project_crontab(project_name=None, project_username=None,
                               'settings.py')
     cron_email = get_arg(cron_email, 'CRON_EMAIL', 'root@localhost')
     install = get_arg(install, 'INSTALL_CRONTAB', False)
+    cron_hosts = get_arg(cron_hosts, 'CRON_HOSTS', None)
+    checkout_dir = '/home/%s/%s' % (project_username, project_name)
+    project_dir = project_dir or checkout_dir
 
     context = {
         'project_name': project_name,
         'project_username': project_username,
         'cron_email': cron_email,
         'settings_module': settings_module,
+        'project_dir': project_dir,
     }
-    crontab_template = local('find . -name "template.crontab"',
-                             capture=True).strip()
-    project_dir = '/home/%s/%s' % (project_username, project_name)
-    crontab_path = '%s/deploy/crontab' % (project_dir)
-    with settings(user=project_username):
-        files.upload_template(crontab_template, crontab_path, context=context,
-                              use_sudo=False)
-        if install:
-            with cd(project_dir):
-                run('crontab deploy/crontab')
+    host = getattr(env, 'hostname', None)
+    if not host:
+        host = inventory.find(env.host_string)
+        host = host and host['name'] or env.host_string or ''
+    hosts = None
+    if cron_hosts:
+        hosts = [h['name'] for h in inventory.select(cron_hosts)]
+    crontab = cron.schedule(templates.render('template.crontab', context),
+                            host, project_username, hosts, 'template.crontab')
+    digest = _digest(crontab, str(install))
+    if deploy_state is not None and deploy_state.get('crontab') == digest:
+        print(green('Crontab unchanged, skipping.'))
+        return
+    crontab_path = '%s/deploy/crontab' % (checkout_dir)
+    templates.upload('template.crontab', crontab_path, context,
+                     use_sudo=True, text=crontab)
+    if install:
+        with cd(checkout_dir):
+            batch.run_as(project_username, 'crontab deploy/crontab')
+    if deploy_state is not None:
+        deploy_state['crontab'] = digest
+
+
+def _digest(*texts):
+    return hashlib.md5('\0'.join(texts)).hexdigest()
+
+
+def _parse_deploy_state(text):
+    deploy_state = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            deploy_state[fields[0]] = fields[1]
+    return deploy_state
+
+
+def _format_deploy_state(deploy_state):
+    return ''.join(['%s %s\n' % item for item in sorted(deploy_state.items())])
 
 
 def setup_project(project_name=None, git_url=None, apache_server_name=None,
@@ -304,6 +593,254 @@ def delete_project_code(project_name=None, project_username=None):
     sudo('rm -rf /home/%s/%s' % (project_username, project_name))
 
 
+def _precompile(script, python, dirs, jobs):
+    """
+    Adds the steps that remove .pyc files whose .py is gone (which python 2
+    would still import) and byte-compile everything under dirs, jobs
+    processes at a time, to script. Symlinks aren't followed.
+    """
+    dirs = ' '.join(dirs)
+    script.add("find %s -name '*.pyc' -type f -exec sh -c "
+               "'for f; do [ -e \"${f%%c}\" ] || rm -f \"$f\"; done' sh {} +"
+               % dirs, warn_only=True)
+    # compileall skips files whose .pyc is up to date; files that don't
+    # compile (templates, python 3 only code) are left to fail at import
+    script.add("find %s -name '*.py' -print0 | "
+               "xargs -0 -r -n 200 -P %s %s -m compileall -q >/dev/null 2>&1"
+               % (dirs, jobs, python), warn_only=True)
+
+
+def _import_wsgi(script, home_dir, python, wsgi_path):
+    """
+    Adds a step that imports the wsgi file at wsgi_path with python, which
+    fails if the application doesn't load, to script.
+    """
+    script.add('cd %s && %s -c %s' % (home_dir, python, batch.shell_quote(
+        'import imp; imp.load_source("louis_wsgi", "%s")' % wsgi_path)))
+
+
+_MIGRATIONS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS louis_migrations (
+    project text NOT NULL,
+    project_username text NOT NULL,
+    revision text NOT NULL,
+    host text NOT NULL,
+    state text NOT NULL,
+    started timestamp with time zone NOT NULL DEFAULT now(),
+    finished timestamp with time zone,
+    PRIMARY KEY (project, project_username, revision)
+);"""
+
+# prints the project's default database settings as libpq variables, each
+# NAME=value ended by a NUL, for the shell to export without evaluating them
+_DATABASE_ENV_SCRIPT = """import os, sys
+os.environ['DJANGO_SETTINGS_MODULE'] = sys.argv[1]
+from django.conf import settings
+db = settings.DATABASES['default']
+for key, name in [('NAME', 'PGDATABASE'), ('USER', 'PGUSER'),
+                  ('PASSWORD', 'PGPASSWORD'), ('HOST', 'PGHOST'),
+                  ('PORT', 'PGPORT')]:
+    if db.get(key):
+        sys.stdout.write('%s=%s\\0' % (name, str(db[key])))
+"""
+
+
+def _migration_timings(output):
+    """
+    Returns (migration, start, seconds) for every migration in the output of
+    manage.py migrate, each line of which starts with the time it was
+    printed at. South prints a migration's name before running it, and
+    django's own migrate after it's done.
+    """
+    lines = []
+    for line in output.splitlines():
+        stamp, _, text = line.partition(' ')
+        try:
+            lines.append((float(stamp), text.split()))
+        except ValueError:
+            continue
+    timings = []
+    for i, (stamp, words) in enumerate(lines):
+        if len(words) < 2:
+            continue
+        if words[0] == '>':
+            end = i + 1 < len(lines) and lines[i + 1][0] or stamp
+            timings.append((words[1], stamp, end - stamp))
+        elif words[0] == 'Applying':
+            start = i and lines[i - 1][0] or stamp
+            timings.append((words[1].rstrip('.'), start, stamp - start))
+    return timings
+
+
+def _migration_log(timings):
+    return ['  migrated %s in %.1fs' % (migration, seconds)
+            for migration, start, seconds in timings]
+
+
+def _migrate(project_name, project_username, project_dir, python,
+             settings_module, revision, timeout=None, dsn=None):
+    """
+    Runs manage.py migrate for revision on exactly one of the hosts that
+    deploy it against the same database, and has the other ones wait for it.
+
+    The hosts meet in a louis_migrations table of the database at dsn
+    (louisconf.MIGRATION_DSN, a psql connection string, or else the
+    project's default database): the first one to claim the project, project
+    user and revision, under an advisory lock, migrates, and the others poll
+    the table until it's done, for up to timeout seconds
+    (louisconf.MIGRATION_TIMEOUT or 1800). A claim that failed or is older
+    than timeout is taken over by the next host. Aborts if the migrations
+    failed or didn't finish in time, and otherwise returns (migration, start,
+    seconds) for each migration this host ran.
+    """
+    from fabric.api import abort
+    from louis import trace
+    from louis.commands.databases import _sql_literal
+
+    timeout = int(get_arg(timeout, 'MIGRATION_TIMEOUT', 1800))
+    dsn = get_arg(dsn, 'MIGRATION_DSN', None)
+    host = env.get('hostname') or env.host_string
+    psql = 'psql -X -q -tA -v ON_ERROR_STOP=1%s' % (
+        dsn and ' -d "$LOUIS_DSN"' or '')
+    # the project user tells apart deployments of the same project, e.g. of
+    # different branches, which have databases of their own but may share
+    # the one at dsn
+    where = 'project = %s AND project_username = %s AND revision = %s' % (
+        _sql_literal(project_name), _sql_literal(project_username),
+        _sql_literal(revision))
+    claim = '\n'.join([
+        'BEGIN;',
+        'SET LOCAL client_min_messages = warning;',
+        "SELECT 'lock', pg_advisory_xact_lock(hashtext('louis_migrations'));",
+        _MIGRATIONS_TABLE_SQL,
+        "DELETE FROM louis_migrations WHERE %s AND (state = 'failed' OR "
+        "started < now() - interval '%s seconds' AND state = 'running');" %
+        (where, timeout),
+        "INSERT INTO louis_migrations "
+        "(project, project_username, revision, host, state) "
+        "SELECT %s, %s, %s, %s, 'running' WHERE NOT EXISTS "
+        "(SELECT 1 FROM louis_migrations WHERE %s);" %
+        (_sql_literal(project_name), _sql_literal(project_username),
+         _sql_literal(revision), _sql_literal(host), where),
+        "SELECT 'host', host FROM louis_migrations WHERE %s;" % where,
+        'COMMIT;'])
+    finished = "UPDATE louis_migrations SET state = '%s', finished = now() " \
+               "WHERE " + where + ";"
+    me = batch.shell_quote(host)
+
+    script = batch.RemoteScript(use_sudo=True, user=project_username)
+    script.add('cd %s' % project_dir)
+    if dsn:
+        script.add('LOUIS_DSN=%s' % batch.shell_quote(dsn))
+    else:
+        script.add("while IFS= read -r -d '' var; do export \"$var\"; "
+                   "done < <(%s -c %s %s)" % (
+            python, batch.shell_quote(_DATABASE_ENV_SCRIPT), settings_module))
+    script.add("winner=$(%s <<'LOUIS_SQL' | sed -n 's/^host|//p'\n%s\n"
+               "LOUIS_SQL\n) && echo \"$winner\"" % (psql, claim))
+    # every line of the output gets the time it was printed at
+    script.add('if [ "$winner" = %s ]; then\n'
+               '%s manage.py migrate --merge --settings=%s 2>&1 | '
+               'while IFS= read -r line; do '
+               'echo "$(date +%%s.%%N) $line"; done\n'
+               'rc=${PIPESTATUS[0]}\n'
+               '[ $rc -eq 0 ] && sql=%s || sql=%s\n'
+               '%s -c "$sql"; (exit $rc)\n'
+               'fi' % (me, python, settings_module,
+                       batch.shell_quote(finished % 'done'),
+                       batch.shell_quote(finished % 'failed'), psql),
+               warn_only=True)
+    script.add('if [ "$winner" != %s ]; then waited=0\n'
+               'while state=$(%s -c %s) && [ "$state" = running ] && '
+               '[ $waited -lt %s ]; do sleep 2; waited=$((waited + 2)); done\n'
+               'echo "$state"; [ "$state" = done ]\n'
+               'fi' % (me, psql, batch.shell_quote(
+                   'SELECT state FROM louis_migrations WHERE %s;' % where),
+                   timeout), warn_only=True)
+    script.execute()
+
+    winner = script.step_outputs[-3]
+    if winner != host:
+        state = (script.step_outputs[-1].split() or ['gone'])[-1]
+        if state == 'running':
+            abort('Migrations of %s on %s are still running after %ss.' %
+                  (revision, winner, timeout))
+        if state != 'done':
+            abort('Migrations of %s on %s %s.' % (revision, winner, state))
+        print(green('Migrations of %s were run by %s.' % (revision, winner)))
+        return []
+    timings = _migration_timings(script.step_outputs[-2])
+    for migration, start, seconds in timings:
+        trace.record(migration, 'migration', start, seconds)
+        print(green('Migrated %s in %.1fs.' % (migration, seconds)))
+    if script.return_codes[-2]:
+        abort('Migrations of %s failed on %s.' % (revision, host))
+    return timings
+
+
+def warm_up_project(project_name=None, project_username=None,
+                    server_name=None, warmup_urls=None, compile_jobs=None,
+                    project_dir=None, env_dir=None, precompile=True,
+                    import_check=True):
+    """
+    Gets a deployed project ready for traffic, so that the first requests
+    after a deploy don't pay for compiling and importing it.
+
+    The project and its virtualenv are byte-compiled compile_jobs files at a
+    time (louisconf.COMPILE_JOBS, defaults to the host's CPUs) and .pyc files
+    left over from deleted modules are removed. The project's wsgi file is
+    then imported once, which aborts the deploy if the application doesn't
+    load (unless import_check is false; deploy_release does that before the
+    switch instead). Last, each of warmup_urls (louisconf.WARMUP_URLS, a
+    ;-separated list of paths, / by default) is requested from apache on the
+    host with server_name as the Host header, as many times at once as the
+    mod_wsgi daemons have threads, so that every daemon process loads the
+    application (see the wsgi_import_script context of setup_project_apache
+    to have mod_wsgi do that on its own).
+    """
+    project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
+    project_username = get_arg(project_username, 'PROJECT_USERNAME',
+                               '%s-master' % project_name)
+    server_name = get_arg(server_name, 'SERVER_NAME', 'localhost')
+    warmup_urls = get_arg(warmup_urls, 'WARMUP_URLS', '/')
+    if isinstance(warmup_urls, basestring):
+        warmup_urls = [u for u in warmup_urls.split(';') if u]
+    compile_jobs = int(get_arg(compile_jobs, 'COMPILE_JOBS',
+                               facts.hardware()['cpus']))
+    home_dir = '/home/%s' % project_username
+    project_dir = project_dir or '%s/%s' % (home_dir, project_name)
+    env_dir = env_dir or '%s/env' % home_dir
+    python = '%s/bin/python' % env_dir
+    if precompile in ('False', 'false', '0'):
+        precompile = False
+    if import_check in ('False', 'false', '0'):
+        import_check = False
+
+    script = batch.RemoteScript(use_sudo=True, user=project_username)
+    if precompile:
+        _precompile(script, python, [project_dir, '%s/lib' % env_dir],
+                    compile_jobs)
+    if import_check:
+        _import_wsgi(script, home_dir, python,
+                     '%s/%s.wsgi' % (home_dir, project_username))
+    processes, threads = _wsgi_settings()
+    for url in warmup_urls:
+        script.add("seq %s | xargs -P %s -I{} curl -s -o /dev/null "
+                   "-w '%%{http_code}\n' --max-time 60 -H %s %s" %
+                   (processes * threads, processes * threads,
+                    batch.shell_quote('Host: %s' % server_name),
+                    batch.shell_quote('http://127.0.0.1%s' % url)),
+                   warn_only=True)
+    script.execute()
+    outputs = script.step_outputs[len(script.step_outputs) - len(warmup_urls):]
+    for url, output in zip(warmup_urls, outputs):
+        codes = output.split()
+        bad = [c for c in codes if not c.startswith(('2', '3'))]
+        color = bad and red or green
+        print(color('Warmed up %s with %s requests%s.' % (
+            url, len(codes), bad and ', %s failed (%s)' % (
+                len(bad), ', '.join(sorted(set(bad)))) or '')))
+
+
 def update_project(project_name=None, project_username=None, branch=None,
                    settings_module=None,
                    cron_settings_module=None, cron_email=None,
@@ -311,13 +848,43 @@ def update_project(project_name=None, project_username=None, branch=None,
                    do_update_apache=True,
                    admin_email=None,
                    initial_deployment=False,
-                   do_migrate=False):
+                   do_migrate=False,
+                   force=False,
+                   releases=None,
+                   ship_code=None):
     """
     Pull the latest source to a project deployed at target_directory. Also
     update requirements, apache and wsgi files, and crontab.  The
     target_directory is relative to project user's home dir. target_directory
     defaults to project_username ie /home/project/project/
+
+    Hashes of the requirements file and of the rendered apache, wsgi and
+    crontab files are kept in log/deploy.state, and the pip install, apache
+    update and crontab upload are skipped when their inputs haven't changed
+    since the last deploy. Pass force=True to redo everything.
+
+    With releases=True (or louisconf.USE_RELEASES), deploys a new release
+    directory and switches to it atomically instead of updating the checkout
+    in place; see deploy_release.
+
+    With ship_code (or louisconf.SHIP_CODE), new commits are sent from the
+    deployer (see ship_project_code) instead of being pulled by the host.
+
+    When the code or the requirements changed, the project is warmed up
+    before the deploy is done; see warm_up_project.
+
+    With do_migrate, the migrations are run by only one of the hosts the
+    revision is being deployed to, before apache and the crontab are updated
+    anywhere, and the others wait for them (louisconf.MIGRATION_TIMEOUT
+    seconds at most); see _migrate. How long each migration took goes to
+    log/deploy.log.
     """
+    if get_arg(releases, 'USE_RELEASES', False):
+        return louis.commands.deploy_release(project_name, project_username,
+            branch, settings_module, cron_settings_module, cron_email,
+            apache_server_name, apache_server_alias, do_update_apache,
+            admin_email, initial_deployment, do_migrate, force,
+            ship_code=ship_code)
     project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
     branch = get_arg(branch, 'BRANCH', 'master')
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
@@ -332,50 +899,83 @@ def update_project(project_name=None, project_username=None, branch=None,
                                   'www.%s' % apache_server_name)
     admin_email = get_arg(admin_email, 'ADMIN_EMAIL',
                           'root@%s' % apache_server_name)
+    ship_code = get_arg(ship_code, 'SHIP_CODE', False)
 
     local_user = local('whoami', capture=True)
 
+    if ship_code:
+        ship_project_code(project_name, project_username, branch)
     project_dir = '/home/%s/%s' % (project_username, project_name)
+    requirements_path = '%s/deploy/requirements.txt' % project_dir
+    state_path = '/home/%s/log/deploy.state' % project_username
+    with cd(project_dir):
+        script = batch.RemoteScript(use_sudo=True, user=project_username)
+        script.add('git rev-parse HEAD')
+        script.add('git checkout %s' % branch)
+        script.add(_pull_command(branch, ship_code))
+        script.add('git submodule update')
+        script.add('git rev-parse HEAD')
+        script.add('md5sum %s' % requirements_path)
+        script.add('cat %s 2>/dev/null' % state_path, warn_only=True)
+        script.execute()
+        facts.forget_files(requirements_path)
+        previous_head = script.step_outputs[0]
+        git_head = script.step_outputs[4]
+        requirements_digest = script.step_outputs[5].split()[0]
+        if force:
+            deploy_state = {}
+        else:
+            deploy_state = _parse_deploy_state(script.step_outputs[6])
+
+        requirements_changed = \
+            deploy_state.get('requirements') != requirements_digest
+        if requirements_changed:
+            install_project_requirements(project_username, requirements_path)
+            deploy_state['requirements'] = requirements_digest
+        else:
+            print(green('Requirements unchanged, skipping pip.'))
+    migrations = []
+    if not initial_deployment and do_migrate:
+        migrations = _migrate(project_name, project_username, project_dir,
+                              '/home/%s/env/bin/python' % project_username,
+                              settings_module, git_head)
     with cd(project_dir):
-        with settings(user=project_username):
-            run('git checkout %s' % branch)
-            run('git pull')
-            run('git submodule update')
-            install_project_requirements(project_username,
-                             '%s/deploy/requirements.txt' %
-                             project_dir)
-            if not initial_deployment and do_migrate:
-                run('/home/%s/env/bin/python manage.py migrate '
-                    '--merge --settings=%s' %
-                    (project_username, settings_module))
         if do_update_apache:
             setup_project_apache(project_name, project_username,
                 apache_server_name, apache_server_alias, admin_email,
-                settings_module, branch=branch)
+                settings_module, branch=branch, deploy_state=deploy_state)
         setup_project_crontab(project_name, project_username,
-                              cron_settings_module, cron_email)
-        with settings(user=project_username):
-            run('find -L . -name \'*.pyc\' | xargs -r rm')
-            git_head = run('git rev-parse HEAD')
+                              cron_settings_module, cron_email,
+                              deploy_state=deploy_state)
+        if force or previous_head != git_head or requirements_changed:
+            warm_up_project(project_name, project_username, apache_server_name)
     with cd('/home/%s' % project_username):
         log_text = 'Deploy on %s by %s. HEAD: %s' % (datetime.now(),
                                                      local_user,
                                                      git_head)
-        files.append('log/deploy.log', log_text, use_sudo=True)
+        with batch.RemoteScript(use_sudo=True) as script:
+            script.append('log/deploy.log', [log_text] +
+                          _migration_log(migrations))
+            script.add('printf "%%s" %s > %s' %
+                       (batch.shell_quote(_format_deploy_state(deploy_state)),
+                        state_path))
 
 
 def manage_project(command, project_name=None, project_username=None,
-                   settings_module=None):
+                   settings_module=None, pipe_to=None):
     """
-    Call project's manage.py to peform command.
+    Call project's manage.py to peform command. If pipe_to is given, the
+    command's output is piped into that shell command.
     """
     project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
     project_username = get_arg(project_username, 'PROJECT_USERNAME',
                                '%s-master' % project_name)
     settings_module = get_arg(settings_module, 'SETTINGS_MODULE', 'settings')
 
-    with settings(user=project_username):
-        project_dir = '/home/%s/%s' % (project_username, project_name)
-        with cd(project_dir):
-            run('/home/%s/env/bin/python manage.py %s --settings=%s' %
-                (project_username, command, settings_module))
+    project_dir = '/home/%s/%s' % (project_username, project_name)
+    with cd(project_dir):
+        manage = ('/home/%s/env/bin/python manage.py %s --settings=%s' %
+                  (project_username, command, settings_module))
+        if pipe_to:
+            manage = 'set -o pipefail; %s | %s' % (manage, pipe_to)
+        return batch.run_as(project_username, manage)
@@ -0,0 +1,269 @@
+from __future__ import with_statement
+
+from datetime import datetime
+
+from fabric.api import cd, local, abort
+from fabric.colors import green, red
+
+from louis.utils import get_arg
+from louis import batch
+from louis import facts
+import louis.commands
+from louis.commands.projects import (_parse_deploy_state,
+                                     _format_deploy_state, _pull_command,
+                                     _precompile, _import_wsgi, _migrate,
+                                     _migration_log)
+
+
+# written into a release once it's ready to go live; releases without it
+# were left behind by a deploy that failed, and are never switched to
+COMPLETE_MARKER = '.louis-complete'
+
+
+def _release_paths(project_username):
+    home_dir = '/home/%s' % project_username
+    return home_dir, '%s/releases' % home_dir, '%s/current' % home_dir
+
+
+def deploy_release(project_name=None, project_username=None, branch=None,
+                   settings_module=None,
+                   cron_settings_module=None, cron_email=None,
+                   apache_server_name=None, apache_server_alias=None,
+                   do_update_apache=True,
+                   admin_email=None,
+                   initial_deployment=False,
+                   do_migrate=False,
+                   force=False,
+                   keep_releases=None,
+                   ship_code=None):
+    """
+    Deploys the latest source as a new release and switches to it atomically.
+
+    The code is cloned from the checkout in /home/project_username/project_name
+    into /home/project_username/releases/<timestamp>/, next to a copy of the
+    current release's virtualenv which gets the requirements installed. Only
+    once the release is complete (and migrated, with do_migrate) is the
+    /home/project_username/current symlink switched over to it and apache
+    gracefully reloaded, so requests never see a half-updated tree. Apache and
+    crontab templates get project_dir and env_dir under current/. The
+    release is byte-compiled before the switch, its wsgi file (pointed at the
+    release rather than current/) is imported, which aborts the deploy if the
+    application doesn't load, and it's warmed up right after the switch (see
+    warm_up_project). When several hosts deploy it at once, only one of
+    them migrates the database, and the others wait for it before switching
+    (see _migrate in louis.commands.projects).
+
+    The release is marked as complete when it's switched to, so that a deploy
+    that fails on the way leaves nothing rollback_project would use. The
+    newest keep_releases (louisconf.KEEP_RELEASES or 5) releases are kept;
+    use rollback_project to switch back to one of them.
+    """
+    project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
+    branch = get_arg(branch, 'BRANCH', 'master')
+    project_username = get_arg(project_username, 'PROJECT_USERNAME',
+                               '%s-%s' % (project_name, branch))
+    settings_module = get_arg(settings_module, 'SETTINGS_MODULE', 'settings')
+    cron_settings_module = get_arg(cron_settings_module,
+                                   'CRON_SETTINGS_MODULE', settings_module)
+    cron_email = get_arg(cron_email, 'CRON_EMAIL', 'root@localhost')
+    apache_server_name = get_arg(apache_server_name, 'SERVER_NAME',
+                                 'localhost')
+    apache_server_alias = get_arg(apache_server_alias, 'SERVER_ALIAS',
+                                  'www.%s' % apache_server_name)
+    admin_email = get_arg(admin_email, 'ADMIN_EMAIL',
+                          'root@%s' % apache_server_name)
+    keep_releases = int(get_arg(keep_releases, 'KEEP_RELEASES', 5))
+    ship_code = get_arg(ship_code, 'SHIP_CODE', False)
+
+    local_user = local('whoami', capture=True)
+    home_dir, releases_dir, current = _release_paths(project_username)
+    checkout_dir = '%s/%s' % (home_dir, project_name)
+    release = datetime.now().strftime('%Y%m%d%H%M%S')
+    release_dir = '%s/%s' % (releases_dir, release)
+    release_env = '%s/env' % release_dir
+    requirements = '%s/deploy/requirements.txt' % project_name
+    state_path = '%s/log/deploy.state' % home_dir
+
+    if ship_code:
+        louis.commands.ship_project_code(project_name, project_username,
+                                         branch)
+    script = batch.RemoteScript(use_sudo=True, user=project_username)
+    script.add('cd %s' % checkout_dir)
+    script.add('git checkout %s' % branch)
+    script.add(_pull_command(branch, ship_code))
+    script.add('git rev-parse HEAD')
+    script.add('git clone -q --local --branch %s %s %s/%s' %
+               (branch, checkout_dir, release_dir, project_name))
+    script.add('cd %s/%s && git submodule update --init' %
+               (release_dir, project_name))
+    # snapshot the virtualenv the current release runs on, and point its
+    # scripts at the snapshot
+    script.add('if [ -e %s/env ]; then src=$(readlink -f %s/env); '
+               'else src=%s/env; fi; cp -a "$src" %s && '
+               'grep -lI -r "$src" %s/bin | xargs -r sed -i "s|$src|%s|g"' %
+               (current, current, home_dir, release_env, release_env,
+                release_env))
+    script.add('md5sum %s/%s' % (release_dir, requirements))
+    script.add('md5sum %s/%s 2>/dev/null' % (current, requirements),
+               warn_only=True)
+    script.add('cat %s 2>/dev/null' % state_path, warn_only=True)
+    script.execute()
+    git_head = script.step_outputs[3]
+    requirements_digest = script.step_outputs[7].split()[0]
+    current_digest = (script.step_outputs[8].split() or [None])[0]
+    if force:
+        deploy_state = {}
+    else:
+        deploy_state = _parse_deploy_state(script.step_outputs[9])
+
+    if force or requirements_digest != current_digest:
+        louis.commands.install_project_requirements(
+            project_username, '%s/%s' % (release_dir, requirements),
+            env_path=release_env)
+    else:
+        print(green('Requirements unchanged, reusing the current virtualenv.'))
+
+    # compiled before it goes live, so that no request pays for it
+    with batch.RemoteScript(use_sudo=True, user=project_username) as script:
+        _precompile(script, '%s/bin/python' % release_env,
+                    ['%s/%s' % (release_dir, project_name),
+                     '%s/lib' % release_env],
+                    int(get_arg(None, 'COMPILE_JOBS',
+                                facts.hardware()['cpus'])))
+
+    migrations = []
+    if not initial_deployment and do_migrate:
+        migrations = _migrate(project_name, project_username,
+                              '%s/%s' % (release_dir, project_name),
+                              '%s/bin/python' % release_env, settings_module,
+                              git_head)
+
+    if do_update_apache:
+        louis.commands.setup_project_apache(project_name, project_username,
+            apache_server_name, apache_server_alias, admin_email,
+            settings_module, branch=branch, deploy_state=deploy_state,
+            project_dir='%s/%s' % (current, project_name),
+            env_dir='%s/env' % current)
+    louis.commands.setup_project_crontab(project_name, project_username,
+        cron_settings_module, cron_email, deploy_state=deploy_state,
+        project_dir='%s/%s' % (current, project_name))
+
+    # the application has to load from the release before it goes live
+    wsgi_path = '%s/%s.wsgi' % (home_dir, project_username)
+    release_wsgi = '%s/louis-check.wsgi' % release_dir
+    with batch.RemoteScript(use_sudo=True, user=project_username) as script:
+        script.add('sed "s|%s/|%s/|g" %s > %s' %
+                   (current, release_dir, wsgi_path, release_wsgi))
+        _import_wsgi(script, home_dir, '%s/bin/python' % release_env,
+                     release_wsgi)
+
+    _activate_release(project_username, release, complete=True)
+    louis.commands.warm_up_project(project_name, project_username,
+        apache_server_name, precompile=False, import_check=False,
+        project_dir='%s/%s' % (current, project_name),
+        env_dir='%s/env' % current)
+    prune_releases(project_username, keep_releases)
+
+    log_text = 'Deploy of release %s on %s by %s. HEAD: %s' % (
+        release, datetime.now(), local_user, git_head)
+    with cd(home_dir):
+        with batch.RemoteScript(use_sudo=True) as script:
+            script.append('log/deploy.log', [log_text] +
+                          _migration_log(migrations))
+            script.add('printf "%%s" %s > %s' %
+                       (batch.shell_quote(_format_deploy_state(deploy_state)),
+                        state_path))
+    print(green('Release %s is live.' % release))
+
+
+def _activate_release(project_username, release, complete=False):
+    """
+    Atomically points current at the given release and reloads apache. With
+    complete, the release is marked as complete first; otherwise it must have
+    been already.
+    """
+    home_dir, releases_dir, current = _release_paths(project_username)
+    marker = '%s/%s/%s' % (releases_dir, release, COMPLETE_MARKER)
+    batch.run_as(project_username,
+                 '%s %s && ln -sfn %s/%s %s.tmp && mv -Tf %s.tmp %s' %
+                 (complete and 'touch' or 'test -e', marker, releases_dir,
+                  release, current, current, current))
+    louis.commands.apache_reload()
+
+
+def _project_username(project_username, project_name, branch):
+    # the same default as deploy_release's
+    project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
+    branch = get_arg(branch, 'BRANCH', 'master')
+    return get_arg(project_username, 'PROJECT_USERNAME',
+                   '%s-%s' % (project_name, branch))
+
+
+def list_releases(project_username=None, project_name=None, branch=None):
+    """
+    Lists the project's complete releases, oldest first, and returns them
+    along with the current one. Releases left behind by failed deploys are
+    left out.
+    """
+    project_username = _project_username(project_username, project_name,
+                                         branch)
+    home_dir, releases_dir, current = _release_paths(project_username)
+    script = batch.RemoteScript(use_sudo=True, user=project_username)
+    script.add('for release in $(ls -1 %s | sort); do '
+               '[ -e %s/$release/%s ] && echo $release; done; true' %
+               (releases_dir, releases_dir, COMPLETE_MARKER))
+    script.add('basename $(readlink -f %s)' % current)
+    script.execute()
+    releases = script.step_outputs[0].split()
+    active = script.step_outputs[1]
+    for release in releases:
+        if release == active:
+            print(green('%s (current)' % release))
+        else:
+            print(release)
+    return releases, active
+
+
+def rollback_project(project_username=None, release=None, project_name=None,
+                     branch=None, since=None):
+    """
+    Switches current back to the release before it, or to the given release,
+    and gracefully reloads apache. Nothing is rebuilt.
+
+    With since, a release name (the time it was made, as %Y%m%d%H%M%S),
+    current is switched back to the last release before since, and left
+    alone if it's older than that already.
+    """
+    project_username = _project_username(project_username, project_name,
+                                         branch)
+    releases, active = list_releases(project_username)
+    if since is not None and active < since:
+        print(green('%s is older than %s, nothing to roll back.' %
+                    (active, since)))
+        return
+    if release is None:
+        older = [r for r in releases if r < (since or active)]
+        if not older:
+            abort('There is no release before %s.' % (since or active))
+        release = older[-1]
+    elif release not in releases:
+        abort('There is no release %s.' % release)
+    print(red('Rolling back from %s to %s' % (active, release)))
+    _activate_release(project_username, release)
+
+
+def prune_releases(project_username=None, keep_releases=None,
+                   project_name=None, branch=None):
+    """
+    Deletes all but the newest keep_releases releases, never deleting the
+    current one.
+    """
+    project_username = _project_username(project_username, project_name,
+                                         branch)
+    keep_releases = int(get_arg(keep_releases, 'KEEP_RELEASES', 5))
+    home_dir, releases_dir, current = _release_paths(project_username)
+    with cd(releases_dir):
+        batch.run_as(project_username,
+                     'active=$(basename $(readlink -f %s)); '
+                     'ls -1 | sort | head -n -%s | grep -v -x "$active" | '
+                     'xargs -r rm -rf' % (current, keep_releases))
@@ -1,8 +1,20 @@
+from __future__ import with_statement
+
+import hashlib
 import os
+from datetime import datetime
 
-from fabric.api import run, put, sudo, env, cd, local, prompt, settings
+from fabric.api import (run, put, sudo, env, cd, local, prompt, settings,
+                        abort, hide)
+from fabric.colors import green, red
 from fabric.contrib.files import comment
 
+from louis.utils import get_arg
+from louis import batch
+from louis import facts
+import louis
+import louis.commands
+
 
 def install_solr_schema(local_path='deploy/solr_home/conf/', 
                         dest_path='/etc/solr/conf/'):
@@ -12,8 +24,18 @@ def install_solr_schema(local_path='deploy/solr_home/conf/',
 
 
 def config_jetty(local_path='deploy/jetty', dest_path='/etc/default/jetty'):
+    """
+    Installs jetty's defaults file (JVM settings and the like) and restarts
+    jetty, which is the only way to apply them. Does nothing if the host's
+    file is the same already.
+    """
+    if _local_md5(local_path) == facts.file_checksum(dest_path):
+        print(green('%s unchanged, not restarting jetty.' % dest_path))
+        return False
     put(local_path, dest_path, use_sudo=True)
+    facts.forget_files(dest_path)
     restart_jetty()
+    return True
 
 
 def restart_jetty():
@@ -21,12 +43,270 @@ def restart_jetty():
     sudo('/etc/init.d/jetty start')
 
 
-def build_solr_index():
-    pass
+def build_solr_index(project_name=None, project_username=None,
+                     export_command=None, solr_url=None, batch_size=None,
+                     workers=None, commit_interval=None, resume=True):
+    """
+    Indexes the project's documents into Solr.
+
+    The project's export_command (louisconf.SOLR_EXPORT_COMMAND, defaults to
+    export_solr_documents) is run through manage_project and has to print
+    one JSON document per line. Its output is piped into louis's indexer
+    (louis/solr_index.py, uploaded to the project user's home), which posts
+    batch_size documents at a time (louisconf.SOLR_BATCH_SIZE or 500) to
+    solr_url (louisconf.SOLR_URL or http://localhost:8080/solr) from workers
+    processes (louisconf.SOLR_WORKERS or 4), commits every commit_interval
+    seconds (louisconf.SOLR_COMMIT_INTERVAL or 60) and reports docs/sec.
+
+    A build that fails resumes after the last commit when run again, unless
+    resume is false.
+    """
+    project_name = get_arg(project_name, 'PROJECT_NAME', 'project')
+    project_username = get_arg(project_username, 'PROJECT_USERNAME',
+                               '%s-master' % project_name)
+    export_command = get_arg(export_command, 'SOLR_EXPORT_COMMAND',
+                             'export_solr_documents')
+    solr_url = get_arg(solr_url, 'SOLR_URL', 'http://localhost:8080/solr')
+    batch_size = int(get_arg(batch_size, 'SOLR_BATCH_SIZE', 500))
+    workers = int(get_arg(workers, 'SOLR_WORKERS', 4))
+    commit_interval = float(get_arg(commit_interval, 'SOLR_COMMIT_INTERVAL',
+                                    60))
+    if resume in ('False', 'false', '0'):
+        resume = False
+
+    home_dir = '/home/%s' % project_username
+    indexer = '%s/solr_index.py' % home_dir
+    checkpoint = '%s/log/solr_index.checkpoint' % home_dir
+    put(os.path.join(os.path.dirname(louis.__file__), 'solr_index.py'),
+        indexer, use_sudo=True)
+    if not resume:
+        batch.run_as(project_username, 'rm -f %s' % checkpoint)
+    louis.commands.manage_project(export_command, project_name,
+        project_username,
+        pipe_to='%s/env/bin/python %s -b %s -w %s -c %s %s %s' %
+                (home_dir, indexer, batch_size, workers, commit_interval,
+                 solr_url, checkpoint))
+
+
+def _local_md5(path):
+    return hashlib.md5(open(path, 'rb').read()).hexdigest()
+
+
+def _validate_schema(path):
+    """
+    Aborts unless the schema at path is well-formed XML with a <schema> root
+    that defines fields. Solr does the full validation when it loads it.
+    """
+    from xml.dom import minidom
+
+    try:
+        document = minidom.parse(path)
+    except Exception as e:
+        abort('%s is not valid XML: %s' % (path, e))
+    root = document.documentElement
+    if root.tagName != 'schema' or not root.getElementsByTagName('field'):
+        abort('%s is not a Solr schema.' % path)
+
+
+def _core_admin(solr_url, action, **params):
+    """
+    Runs a CoreAdmin action from the host. Returns the curl result, whose
+    failed attribute tells whether Solr refused it.
+    """
+    import urllib
+
+    params['action'] = action
+    params['wt'] = 'json'
+    url = '%s/admin/cores?%s' % (solr_url, urllib.urlencode(sorted(
+        params.items())))
+    with settings(warn_only=True):
+        return run('curl -sSf %s' % batch.shell_quote(url))
+
+
+def _parse_queries(queries):
+    if isinstance(queries, basestring):
+        return [q for q in queries.split(';') if q]
+    return list(queries or [])
+
+
+def warm_solr_core(core, solr_url=None, queries=None):
+    """
+    Runs the warm-up queries (a ;-separated list, or
+    louisconf.SOLR_WARMUP_QUERIES) against a core, all from one script on the
+    host, so that its caches are filled before it takes traffic.
+    """
+    solr_url = get_arg(solr_url, 'SOLR_URL', 'http://localhost:8080/solr')
+    queries = _parse_queries(get_arg(queries, 'SOLR_WARMUP_QUERIES', None))
+    if not queries:
+        return
+    import urllib
+
+    base = '%s/%s' % (solr_url, core)
+    script = batch.RemoteScript()
+    for query in queries:
+        script.add('curl -sSf -o /dev/null %s' % batch.shell_quote(
+            '%s/select?%s' % (base, urllib.urlencode({'q': query,
+                                                      'rows': 10}))))
+    with settings(hide('stdout')):
+        script.execute()
+    print(green('Ran %s warm-up queries against %s.' % (len(queries), base)))
+
+
+# keeps the warm-up listeners louis adds to solrconfig.xml apart from the rest
+WARMUP_MARKER = 'louis warm-up'
+
+# run on the host: replaces the warm-up listeners in the solrconfig.xml at
+# argv[1] with argv[2], and says whether that changed the file
+_SET_LISTENERS_SCRIPT = """import re, sys
+path, block = sys.argv[1], sys.argv[2]
+text = open(path).read()
+new = re.sub(r'\\s*<!-- %s -->.*?<!-- /%s -->', '', text, flags=re.S)
+if block:
+    new = new.replace('</query>', block + '\\n  </query>', 1)
+if new != text:
+    open(path, 'w').write(new)
+    print('changed')
+""" % (WARMUP_MARKER, WARMUP_MARKER)
+
+
+def _core_instance_dir(solr_url, core):
+    """
+    Returns the instanceDir of core according to CoreAdmin, or None if
+    there's no CoreAdmin at solr_url.
+    """
+    import json
+
+    status = _core_admin(solr_url, 'STATUS', core=core)
+    if status.failed:
+        return None
+    instance_dir = json.loads(status)['status'].get(core, {}).get(
+        'instanceDir')
+    if not instance_dir:
+        abort('Solr has no core %s.' % core)
+    return instance_dir.rstrip('/')
+
+
+def _warmup_listeners(queries):
+    """
+    Returns the solrconfig.xml <listener>s that run queries on every new
+    searcher before it's used: the first one of a core that's (re)loaded,
+    and the ones opened after commits.
+    """
+    from xml.sax.saxutils import escape
+
+    if not queries:
+        return ''
+    lines = ['    <!-- %s -->' % WARMUP_MARKER]
+    for event in ('firstSearcher', 'newSearcher'):
+        lines.append('    <listener event="%s" '
+                     'class="solr.QuerySenderListener">' % event)
+        lines.append('      <arr name="queries">')
+        for query in queries:
+            lines.append('        <lst><str name="q">%s</str>'
+                         '<str name="rows">10</str></lst>' % escape(query))
+        lines.append('      </arr>')
+        lines.append('    </listener>')
+    lines.append('    <!-- /%s -->' % WARMUP_MARKER)
+    return '\n'.join(lines)
+
+
+def deploy_solr_schema(local_path='deploy/solr_home/conf/', dest_path=None,
+                       core=None, solr_url=None, swap=False,
+                       warmup_queries=None):
+    """
+    Rolls out a new schema.xml without taking search down.
+
+    The schema is checked locally and uploaded to the conf/ of the core
+    (louisconf.SOLR_CORE, defaults to collection1) as CoreAdmin reports it,
+    or to dest_path (/etc/solr/conf/ without CoreAdmin), if it differs from
+    the host's copy. By default the core is then reloaded through CoreAdmin:
+    Solr keeps serving from the old core until the new one has loaded, and
+    if it fails to load the old schema is put back. The warm-up queries (see
+    warm_solr_core) are set up as firstSearcher and newSearcher listeners in
+    the core's solrconfig.xml, so that the reloaded core runs them before its
+    searcher serves anything. With swap, a new core is created next to the
+    current one from a copy of its conf/ with the new schema, gets a full
+    index build (see build_solr_index) and is warmed before it is swapped in
+    for the current one, so that schema changes that need a reindex go live
+    all at once.
+
+    Solr setups without CoreAdmin fall back to restarting jetty.
+    """
+    core = get_arg(core, 'SOLR_CORE', 'collection1')
+    solr_url = get_arg(solr_url, 'SOLR_URL', 'http://localhost:8080/solr')
+    queries = _parse_queries(get_arg(warmup_queries, 'SOLR_WARMUP_QUERIES',
+                                     None))
+    if swap in ('False', 'false', '0'):
+        swap = False
+    local_file = os.path.join(local_path, 'schema.xml')
+    _validate_schema(local_file)
+    instance_dir = _core_instance_dir(solr_url, core)
+    if swap:
+        if instance_dir is None:
+            abort('Swapping cores needs CoreAdmin at %s.' % solr_url)
+        return _swap_solr_core(local_file, core, solr_url, instance_dir,
+                               queries)
+
+    if instance_dir is not None:
+        dest_path = dest_path or '%s/conf' % instance_dir
+    dest_path = (dest_path or '/etc/solr/conf').rstrip('/')
+    dest_file = '%s/schema.xml' % dest_path
+    config_file = '%s/solrconfig.xml' % dest_path
+    schema_changed = _local_md5(local_file) != facts.file_checksum(dest_file)
+    with batch.RemoteScript(use_sudo=True) as script:
+        for path in (dest_file, config_file):
+            script.add('cp -p %s %s.previous 2>/dev/null; true' % (path, path))
+        script.add('if [ -e %s ]; then python -c %s %s %s; fi' % (
+            config_file, batch.shell_quote(_SET_LISTENERS_SCRIPT), config_file,
+            batch.shell_quote(_warmup_listeners(queries))))
+    config_changed = script.step_outputs[-1] == 'changed'
+    if not (schema_changed or config_changed):
+        print(green('%s and its warm-up queries are unchanged.' % dest_file))
+        return
+    if schema_changed:
+        put(local_file, dest_file, use_sudo=True)
+    facts.forget_files(dest_file, config_file)
+    if instance_dir is None:
+        print(red('No CoreAdmin at %s, restarting jetty instead.' % solr_url))
+        restart_jetty()
+    elif _core_admin(solr_url, 'RELOAD', core=core).failed:
+        sudo('mv %s.previous %s; mv %s.previous %s; true' %
+             (dest_file, dest_file, config_file, config_file))
+        facts.forget_files(dest_file, config_file)
+        _core_admin(solr_url, 'RELOAD', core=core)
+        abort('Solr could not load the new schema; the old one is back.')
+    print(green('Reloaded %s with %s.' % (core, dest_file)))
+
+
+def _swap_solr_core(local_file, core, solr_url, instance_dir, queries):
+    new_core = '%s_next' % core
+    new_dir = '%s/%s-%s' % (os.path.dirname(instance_dir), core,
+                            datetime.now().strftime('%Y%m%d%H%M%S'))
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.add('mkdir -p %s' % new_dir)
+        script.add('cp -a %s/conf %s/conf' % (instance_dir, new_dir))
+        script.add('python -c %s %s/conf/solrconfig.xml %s' % (
+            batch.shell_quote(_SET_LISTENERS_SCRIPT), new_dir,
+            batch.shell_quote(_warmup_listeners(queries))))
+    put(local_file, '%s/conf/schema.xml' % new_dir, use_sudo=True)
+    sudo('chown -R --reference=%s %s' % (instance_dir, new_dir))
+    if _core_admin(solr_url, 'CREATE', name=new_core, instanceDir=new_dir,
+                   dataDir='%s/data' % new_dir).failed:
+        sudo('rm -rf %s' % new_dir)
+        abort('Solr could not load the new schema; nothing was changed.')
+
+    build_solr_index(solr_url='%s/%s' % (solr_url, new_core), resume=False)
+    warm_solr_core(new_core, solr_url, queries)
+    if _core_admin(solr_url, 'SWAP', core=core, other=new_core).failed:
+        abort('Swapping %s and %s failed; %s is still live.' %
+              (new_core, core, core))
+    _core_admin(solr_url, 'UNLOAD', core=new_core)
+    print(green('%s now serves from %s; the old core in %s was unloaded.' %
+                (core, new_dir, instance_dir)))
 
 
 def install_solr(build_index=True):
-    install_solr_schema()
+    deploy_solr_schema()
     config_jetty()
     if build_index:
-        build_solr_index()
\ No newline at end of file
+        build_solr_index()
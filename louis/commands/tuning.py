@@ -0,0 +1,171 @@
+from __future__ import with_statement
+
+from fabric.api import sudo, settings, hide
+from fabric.colors import green, red
+
+from louis import batch
+from louis import facts
+from louis.utils import get_arg
+
+POSTGRES_TUNING_FILE = 'louis-tuning.conf'
+SYSCTL_TUNING_PATH = '/etc/sysctl.d/60-louis-tuning.conf'
+# postgres settings that only take effect on a restart rather than a reload
+POSTGRES_RESTART_SETTINGS = ('shared_buffers', 'max_connections')
+
+
+def _postgres_settings(hardware):
+    """
+    Postgres settings for the host's hardware, given the share of its memory
+    postgres gets (louisconf.POSTGRES_MEMORY_SHARE, 0.5 by default since
+    louis hosts usually run apache too).
+    """
+    share = float(get_arg(None, 'POSTGRES_MEMORY_SHARE', 0.5))
+    max_connections = int(get_arg(None, 'POSTGRES_MAX_CONNECTIONS', 100))
+    memory = int(hardware['memory_mb'] * share)
+    shared_buffers = max(32, min(memory // 4, 8192))
+    ssd = not hardware['rotational']
+    return [
+        ('max_connections', max_connections),
+        ('shared_buffers', '%sMB' % shared_buffers),
+        ('effective_cache_size', '%sMB' % max(64, memory * 3 // 4)),
+        ('work_mem', '%sMB' % max(1, (memory - shared_buffers) //
+                                  (max_connections * 3))),
+        ('maintenance_work_mem', '%sMB' % max(16, min(memory // 16, 2048))),
+        ('checkpoint_completion_target', 0.9),
+        ('random_page_cost', ssd and 1.1 or 4),
+        ('effective_io_concurrency', ssd and 200 or 2),
+    ]
+
+
+def _sysctl_settings(hardware):
+    memory_bytes = hardware['memory_mb'] * 1024 * 1024
+    return [
+        ('vm.swappiness', int(get_arg(None, 'SWAPPINESS', 10))),
+        ('vm.dirty_background_ratio', 5),
+        ('vm.dirty_ratio', 10),
+        ('net.core.somaxconn', 1024),
+        # older postgres versions take shared_buffers from SysV shared memory
+        ('kernel.shmmax', memory_bytes // 2),
+        ('kernel.shmall', memory_bytes // 2 // 4096),
+    ]
+
+
+def _wsgi_settings():
+    """
+    Returns the mod_wsgi daemon (processes, threads) for the current host:
+    louisconf.WSGI_PROCESSES or one process per CPU, as long as each gets
+    louisconf.WSGI_PROCESS_MEMORY MB (256 by default), and
+    louisconf.WSGI_THREADS (15) threads each.
+    """
+    hardware = facts.hardware()
+    process_memory = int(get_arg(None, 'WSGI_PROCESS_MEMORY', 256))
+    processes = get_arg(None, 'WSGI_PROCESSES', None)
+    if not processes:
+        processes = max(1, min(hardware['cpus'],
+                               hardware['memory_mb'] // process_memory))
+    return int(processes), int(get_arg(None, 'WSGI_THREADS', 15))
+
+
+def _render_settings(items, separator):
+    lines = ['# computed by louis tune_host, local changes will be lost']
+    lines += ['%s%s%s' % (name, separator, value) for name, value in items]
+    return '\n'.join(lines) + '\n'
+
+
+def _parse_settings(text, separator):
+    items = {}
+    for line in text.splitlines():
+        if line.strip() and not line.startswith('#'):
+            name, sep, value = line.partition(separator)
+            items[name.strip()] = value.strip()
+    return items
+
+
+def _show_diff(path, current, wanted):
+    import difflib
+
+    for line in difflib.unified_diff(current.splitlines(),
+                                     wanted.splitlines(), path, path,
+                                     lineterm=''):
+        if line.startswith('+') and not line.startswith('+++'):
+            print(green(line))
+        elif line.startswith('-') and not line.startswith('---'):
+            print(red(line))
+        else:
+            print(line)
+
+
+def tune_host(postgres=True, kernel=True, dry_run=False):
+    """
+    Tunes postgres and the kernel to the host's memory, CPUs and disk type.
+
+    Postgres gets its memory, connection and planner settings from an include
+    file next to postgresql.conf, and the kernel its swappiness, writeback
+    and shared memory settings from /etc/sysctl.d. Each file is diffed against
+    what's on the host and the diff is shown; only changed files are written,
+    postgres is only reloaded (or restarted, when shared_buffers or
+    max_connections change) if its file changed, and only once the kernel's
+    settings are applied, and with dry_run nothing is written at all. mod_wsgi
+    is tuned through the wsgi_processes and wsgi_threads that
+    setup_project_apache passes to the apache template.
+    """
+    if postgres in ('False', 'false', '0'):
+        postgres = False
+    if kernel in ('False', 'false', '0'):
+        kernel = False
+    if dry_run in ('False', 'false', '0'):
+        dry_run = False
+    hardware = facts.hardware()
+    print('%(memory_mb)sMB of memory, %(cpus)s CPUs, ' % hardware +
+          (hardware['rotational'] and 'rotational disk' or 'SSD'))
+
+    script = batch.RemoteScript(use_sudo=True)
+    script.add('ls -d /etc/postgresql/*/main 2>/dev/null | tail -1',
+               warn_only=True)
+    script.add('cat "$(ls -d /etc/postgresql/*/main 2>/dev/null | tail -1)/%s" '
+               '2>/dev/null' % POSTGRES_TUNING_FILE, warn_only=True)
+    script.add('cat %s 2>/dev/null' % SYSCTL_TUNING_PATH, warn_only=True)
+    with settings(hide('running', 'stdout')):
+        script.execute()
+    postgres_dir = script.step_outputs[0].strip()
+    # the kernel goes first: postgres 9.1 allocates shared_buffers as SysV
+    # shared memory, and won't restart with more of it than kernel.shmmax
+    changes = []
+    if kernel:
+        wanted = _render_settings(_sysctl_settings(hardware), ' = ')
+        changes.append(('kernel', SYSCTL_TUNING_PATH, script.step_outputs[2],
+                        wanted))
+    if postgres and postgres_dir:
+        path = '%s/%s' % (postgres_dir, POSTGRES_TUNING_FILE)
+        wanted = _render_settings(_postgres_settings(hardware), ' = ')
+        changes.append(('postgres', path, script.step_outputs[1], wanted))
+    elif postgres:
+        print(red('Postgres is not installed, not tuning it.'))
+
+    changes = [c for c in changes if c[2].strip() != c[3].strip()]
+    if not changes:
+        print(green('Host is tuned already.'))
+        return
+    for name, path, current, wanted in changes:
+        _show_diff(path, current, wanted)
+    if dry_run:
+        return
+
+    with batch.RemoteScript(use_sudo=True) as script:
+        for name, path, current, wanted in changes:
+            script.add('printf "%%s" %s > %s' %
+                       (batch.shell_quote(wanted), path))
+            if name == 'kernel':
+                script.add('sysctl -q -p %s' % path)
+                continue
+            script.append('%s/postgresql.conf' % postgres_dir,
+                          "include '%s'" % POSTGRES_TUNING_FILE)
+            current = _parse_settings(current, '=')
+            wanted = _parse_settings(wanted, '=')
+            if [s for s in POSTGRES_RESTART_SETTINGS
+                    if current.get(s) != wanted.get(s)]:
+                print(red('Restarting postgres for the new memory settings.'))
+                script.add('service postgresql restart')
+            else:
+                script.add('service postgresql reload')
+    print(green('Applied tuning: %s.' % ', '.join([c[0] for c in changes])))
@@ -2,6 +2,8 @@ from __future__ import with_statement
 from fabric.api import run, put, sudo, env, cd, local, prompt, settings
 from fabric.contrib import files
 from louis import conf
+from louis import batch
+from louis import facts
 
 
 def add_ssh_keys(target_username, ssh_key_path):
@@ -10,19 +12,20 @@ def add_ssh_keys(target_username, ssh_key_path):
     authorized_keys.
     """
     with cd('/home/%s' % target_username):
-        sudo('mkdir -p .ssh')
         put(ssh_key_path, 'keys', use_sudo=True)
-        sudo('cat keys >> .ssh/authorized_keys')
-        sudo('chown -R %s:%s .ssh/' % (target_username, target_username))
-        sudo('rm -f keys')
+        with batch.RemoteScript(use_sudo=True) as script:
+            script.add('mkdir -p .ssh')
+            script.add('cat keys >> .ssh/authorized_keys')
+            script.add('chown -R %s:%s .ssh/' % (target_username,
+                                                 target_username))
+            script.add('rm -f keys')
 
 
 def create_group(groupname):
     """Creates group if it doesn't already exist."""
-    with settings(warn_only=True):
-        check_group = sudo('grep -e "%s" /etc/group' % groupname)
-        if check_group.return_code > 0:
-            sudo('groupadd %s' % groupname)
+    if not facts.group_exists(groupname):
+        sudo('groupadd %s' % groupname)
+        facts.invalidate('groups')
 
 
 def create_user(username, ssh_key_path, shell='bash', admin=False):
@@ -32,15 +35,14 @@ def create_user(username, ssh_key_path, shell='bash', admin=False):
     authorized_keys, so it can contain multiple keys. Pass admin=True for new
     user to be an admin.
     """
-    # TODO: check if user exists and return if so
-    with settings(warn_only=True):
-        if not sudo('grep "%s:" /etc/passwd' % username).failed:
-            return
+    if facts.user_exists(username):
+        return
     if admin:
         create_group('admin')
         sudo('useradd -G admin -m -s `which %s` %s' % (shell, username))
     else:
-        sudo('useradd -m -s' % (shell, username))
+        sudo('useradd -m -s `which %s` %s' % (shell, username))
+    facts.invalidate('users')
     add_ssh_keys(target_username=username, ssh_key_path=ssh_key_path)
 
 
@@ -49,6 +51,7 @@ def delete_user(username):
     Deletes a user and the home directory.
     """
     sudo('userdel -r %s' % username)
+    facts.invalidate('users')
 
 
 def create_sysadmins():
@@ -63,4 +66,5 @@ def config_sudo():
     txt = ['# Members of the admin group may gain root privileges',
            '# They can run any command as root with no password',
            '%admin ALL=(ALL) NOPASSWD: ALL']
-    files.append('/etc/sudoers', txt, use_sudo=True)
\ No newline at end of file
+    with batch.RemoteScript(use_sudo=True) as script:
+        script.append('/etc/sudoers', txt)
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Pooling of the SSH connections fabric opens.
+
+fabric caches one connection per user@host:port for the whole run. The pool
+keeps that behaviour, so every run/sudo/put made as the same user on the same
+host is a new channel on an existing connection rather than a new handshake,
+and adds what a long deploy needs on top of it: keepalives, reconnection of
+dropped connections, eviction of idle ones and a cap on how many are open.
+"""
+import time
+
+from fabric import state
+from fabric.network import HostConnectionCache, normalize_to_string
+
+from louis import conf
+
+
+class ConnectionPool(HostConnectionCache):
+    """
+    fabric's HostConnectionCache with idle eviction and a connection cap.
+
+    Connections are keyed by (user, host, port). When max_connections are open
+    the least recently used one is closed before a new one is made, unless
+    max_connections is 0, and connections that haven't been used in
+    idle_timeout seconds are closed, unless idle_timeout is 0.
+    """
+    max_connections = 16
+    idle_timeout = 300
+    keepalive = 30
+
+    @property
+    def last_used(self):
+        return self.__dict__.setdefault('_last_used', {})
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        self.evict(keep=key)
+        HostConnectionCache.connect(self, key)
+        transport = dict.__getitem__(self, key).get_transport()
+        if transport is not None and self.keepalive:
+            transport.set_keepalive(self.keepalive)
+
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        if dict.__contains__(self, key):
+            transport = dict.__getitem__(self, key).get_transport()
+            if transport is None or not transport.is_active():
+                self.close(key)
+        connection = HostConnectionCache.__getitem__(self, key)
+        self.last_used[key] = time.time()
+        return connection
+
+    def __delitem__(self, key):
+        self.last_used.pop(normalize_to_string(key), None)
+        return HostConnectionCache.__delitem__(self, key)
+
+    def close(self, key):
+        """
+        Closes and forgets the connection for key.
+        """
+        key = normalize_to_string(key)
+        if dict.__contains__(self, key):
+            dict.__getitem__(self, key).close()
+            del self[key]
+
+    def evict(self, keep=None):
+        """
+        Closes idle connections, and then the least recently used ones until
+        there's room for one more.
+        """
+        now = time.time()
+        for key in self.keys():
+            if key != keep and self.idle_timeout and \
+                    now - self.last_used.get(key, now) > self.idle_timeout:
+                self.close(key)
+        while self.max_connections and len(self) >= self.max_connections:
+            candidates = [(self.last_used.get(k, 0), k) for k in self.keys()
+                          if k != keep]
+            if not candidates:
+                break
+            self.close(min(candidates)[1])
+
+
+def install(max_connections=None, idle_timeout=None):
+    """
+    Turns fabric's connection cache into a ConnectionPool. Done in place,
+    since fabric's modules hold on to the cache object itself.
+
+    max_connections and idle_timeout default to louisconf.SSH_MAX_CONNECTIONS
+    and louisconf.SSH_IDLE_TIMEOUT, and 0 turns either off.
+    """
+    # not get_arg, which would take 0 for no setting at all
+    if max_connections is None:
+        max_connections = getattr(conf, 'SSH_MAX_CONNECTIONS', None)
+    if max_connections is None:
+        max_connections = ConnectionPool.max_connections
+    if idle_timeout is None:
+        idle_timeout = getattr(conf, 'SSH_IDLE_TIMEOUT', None)
+    if idle_timeout is None:
+        idle_timeout = ConnectionPool.idle_timeout
+    connections = state.connections
+    connections.__class__ = ConnectionPool
+    connections.max_connections = int(max_connections)
+    connections.idle_timeout = int(idle_timeout)
+    return connections
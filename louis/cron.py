@@ -0,0 +1,131 @@
+"""
+Spreads the jobs of a project's crontab over time and hosts.
+
+The same crontab is installed on every host a project is deployed to, so
+without help its jobs all start at the same second everywhere. In the
+schedule of a job line, a field can say H instead of a number, and the
+number is then picked from a hash of the host, the project user and the
+job's command:
+
+    H               anywhere in the field's range (1-28 for the day of month)
+    H(0-14)         anywhere from 0 to 14
+    H/15            every 15, starting somewhere in the first 15
+    H(0-29)/10      every 10 from 0 to 29, starting somewhere in the first 10
+
+and two flags can come before the schedule:
+
+    @spread(300)    sleep up to 300 seconds before running the command
+    @singleton      run the job on only one of the project's hosts
+
+so that e.g.
+
+    @spread(60) H H(2-5) * * * ./manage.py cleanup
+
+runs once a night on every host, at some minute between 2 and 5 am with up
+to a minute's delay, a different one on each host. A @singleton job is
+given to one host by a hash of the project user and command over all the
+hosts it could run on (rendezvous hashing), and commented out on the others,
+whether or not they're among those hosts.
+Since nothing depends on the time or on the order hosts are deployed in,
+every deploy puts a job in the same place, and adding or removing a host
+only moves the singletons that were on it.
+"""
+import hashlib
+import re
+
+from fabric.api import abort
+
+# the range of each field of a schedule; days of month stop at 28 so that
+# an H day runs every month
+FIELDS = [(0, 59), (0, 23), (1, 28), (1, 12), (0, 6)]
+FIELD_LIMITS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+_HASHED = re.compile(r'^H(?:\((\d+)-(\d+)\))?(?:/(\d+))?$')
+_SPREAD = re.compile(r'^@spread\((\d+)\)$')
+
+
+def _hash(*parts):
+    return int(hashlib.md5('\0'.join(parts)).hexdigest()[:15], 16)
+
+
+def _hashed_field(item, position, seed, source):
+    match = _HASHED.match(item)
+    if match is None:
+        return item
+    low, high, step = match.groups()
+    if low is None:
+        low, high = FIELDS[position]
+    low, high = int(low), int(high)
+    limits = FIELD_LIMITS[position]
+    if not limits[0] <= low <= high <= limits[1]:
+        abort('%s: %s is out of range.' % (source, item))
+    value = _hash(seed, str(position), item)
+    if step:
+        step = int(step)
+        if not step:
+            abort('%s: %s has a step of 0.' % (source, item))
+        return '%s-%s/%s' % (low + value % min(step, high - low + 1), high,
+                             step)
+    return str(low + value % (high - low + 1))
+
+
+def singleton_host(key, hosts):
+    """
+    Returns the host of hosts (a list of names) the job key goes to: the
+    one with the highest hash of key and its name.
+    """
+    if not hosts:
+        return None
+    return max(hosts, key=lambda host: (_hash(key, host), host))
+
+
+def schedule(text, host, key, hosts=None, source='crontab'):
+    """
+    Returns the crontab text as it should be installed on host, with its H
+    fields, @spread and @singleton flags (see above) resolved. key tells
+    apart the crontabs of different projects or branches, and hosts are the
+    names of the hosts a @singleton job may be given to. A @singleton job
+    without any is an error; if they don't include host, the job is
+    commented out there, since it runs on one of them.
+    """
+    lines = []
+    for number, line in enumerate(text.splitlines()):
+        # the command is kept as it was written, whitespace and all; only
+        # the flags and the five fields of the schedule are split off
+        rest = line
+        words = rest.split(None, 1)
+        flags = []
+        while words and (words[0] == '@singleton' or
+                         _SPREAD.match(words[0])):
+            flags.append(words[0])
+            rest = words[1:] and words[1] or ''
+            words = rest.split(None, 1)
+        words = rest.split(None, 5)
+        if not flags and (not words or words[0].startswith(('#', '@')) or
+                          '=' in words[0]):
+            # blank lines, comments, @reboot and the like, and variables
+            lines.append(line)
+            continue
+        where = '%s, line %s' % (source, number + 1)
+        if len(words) < 6:
+            abort('%s: expected a schedule and a command.' % where)
+        command = words[5]
+        seed = '\0'.join([host, key, command])
+        fields = [','.join([_hashed_field(item, position, seed, where)
+                            for item in field.split(',')])
+                  for position, field in enumerate(words[:5])]
+        for flag in flags:
+            match = _SPREAD.match(flag)
+            if match:
+                seconds = _hash(seed, 'spread') % (int(match.group(1)) or 1)
+                command = 'sleep %s; %s' % (seconds, command)
+        job = ' '.join(fields + [command])
+        if '@singleton' in flags and not hosts:
+            abort('%s: @singleton needs the hosts the job may run on '
+                  '(louisconf.CRON_HOSTS).' % where)
+        if '@singleton' in flags:
+            owner = singleton_host('\0'.join([key, words[5]]), hosts)
+            if owner != host:
+                job = '# runs on %s: %s' % (owner, job)
+        lines.append(job)
+    return '\n'.join(lines) + (text.endswith('\n') and '\n' or '')
@@ -0,0 +1,211 @@
+"""
+Per-host cache of facts about the remote system.
+
+Everything louis needs to know to decide whether a step is already done --
+users, groups, installed packages, running services, the checksums of the
+files it manages and the host's memory, CPUs and disk -- is gathered in one
+round trip the first time it's asked for, and then answered locally.
+Commands that change any of it invalidate the relevant part of the cache, so
+the next question goes back to the host.
+"""
+from __future__ import with_statement
+
+from fabric.api import sudo, env, settings, hide
+
+from louis import conf
+
+SECTION_MARKER = '==louis-facts=='
+
+# files whose checksums are gathered up front, on top of louisconf.FACT_PATHS
+WATCHED_PATHS = [
+    '/etc/hosts',
+    '/etc/hostname',
+    '/etc/fstab',
+    '/etc/sudoers',
+    '/etc/localtime',
+    '/etc/ssh/sshd_config',
+    '/etc/apticron/apticron.conf',
+    '/usr/share/zoneinfo/Etc/UTC',
+]
+
+_cache = {}
+
+
+def _host_facts():
+    return _cache.setdefault(env.host_string, {})
+
+
+def _watched_paths():
+    return WATCHED_PATHS + list(getattr(conf, 'FACT_PATHS', []))
+
+
+def _checksums_command(paths):
+    # md5sum for files, '-' for anything else that exists, nothing otherwise
+    quoted = ' '.join(["'%s'" % p for p in paths])
+    return ('for f in %s; do if [ -f "$f" ]; then md5sum "$f"; '
+            'elif [ -e "$f" ]; then echo "- $f"; fi; done' % quoted)
+
+
+def gather():
+    """
+    Gathers all facts about the current host in one round trip.
+    """
+    paths = _watched_paths()
+    sections = [
+        ('users', 'cut -d: -f1 /etc/passwd'),
+        ('groups', 'cut -d: -f1 /etc/group'),
+        ('packages', "dpkg-query -W -f='${Package} ${Version} ${Status}\\n' "
+                     "2>/dev/null"),
+        ('services', 'service --status-all 2>&1'),
+        ('files', _checksums_command(paths)),
+        ('hardware', "echo memory_kb $(awk '/^MemTotal:/ {print $2}' "
+                     "/proc/meminfo); echo cpus $(nproc); "
+                     "echo rotational $(lsblk -ndo ROTA "
+                     "$(findmnt -no SOURCE /) 2>/dev/null | head -1)"),
+    ]
+    script = '\n'.join(['echo "%s %s"; %s' % (SECTION_MARKER, name, command)
+                        for name, command in sections])
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo(script)
+
+    raw = {}
+    current = None
+    for line in output.splitlines():
+        if line.startswith(SECTION_MARKER):
+            current = raw.setdefault(line.split()[1], [])
+        elif current is not None and line.strip():
+            current.append(line.strip())
+
+    facts = _host_facts()
+    facts['users'] = set(raw.get('users', []))
+    facts['groups'] = set(raw.get('groups', []))
+    facts['packages'] = _parse_packages(raw.get('packages', []))
+    facts['services'] = _parse_services(raw.get('services', []))
+    files = dict([(p, None) for p in paths])
+    files.update(_parse_checksums(raw.get('files', [])))
+    facts['files'] = files
+    facts['hardware'] = _parse_hardware(raw.get('hardware', []))
+    return facts
+
+
+def _parse_packages(lines):
+    packages = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 5 and fields[2:] == ['install', 'ok', 'installed']:
+            packages[fields[0]] = fields[1]
+    return packages
+
+
+def _parse_services(lines):
+    # lines look like " [ + ]  apache2"
+    services = {}
+    for line in lines:
+        status, sep, name = line.partition(']')
+        if sep and name.strip():
+            services[name.strip()] = status.strip('[ ') == '+'
+    return services
+
+
+def _parse_hardware(lines):
+    values = dict([(line.split() + [''])[:2] for line in lines])
+    memory_kb = int(values.get('memory_kb') or 0)
+    return {
+        'memory_mb': memory_kb // 1024,
+        'cpus': int(values.get('cpus') or 1),
+        # assume a spinning disk unless the kernel says otherwise
+        'rotational': values.get('rotational') != '0',
+    }
+
+
+def _parse_checksums(lines):
+    checksums = {}
+    for line in lines:
+        checksum, sep, path = line.partition(' ')
+        checksums[path.strip()] = checksum
+    return checksums
+
+
+def get(kind):
+    """
+    Returns the cached facts of the given kind (users, groups, packages,
+    services, files or hardware) for the current host, gathering them if need
+    be.
+    """
+    facts = _host_facts()
+    if kind not in facts:
+        gather()
+    return facts[kind]
+
+
+def invalidate(*kinds):
+    """
+    Drops the given kinds of facts about the current host (all of them if no
+    kind is given) so that they're gathered again when next needed.
+    """
+    facts = _host_facts()
+    for kind in kinds or facts.keys():
+        facts.pop(kind, None)
+
+
+def forget_files(*paths):
+    """
+    Drops what's known about the given remote files. Call after writing them.
+    """
+    files = _host_facts().get('files', {})
+    for path in paths:
+        files.pop(path, None)
+
+
+def user_exists(username):
+    return username in get('users')
+
+
+def group_exists(groupname):
+    return groupname in get('groups')
+
+
+def installed_packages():
+    """
+    Returns a dict of installed package name -> version.
+    """
+    return get('packages')
+
+
+def service_running(name):
+    return get('services').get(name, False)
+
+
+def hardware():
+    """
+    Returns a dict with the host's memory_mb, cpus and whether its root disk
+    is rotational.
+    """
+    return get('hardware')
+
+
+def file_checksum(path):
+    """
+    Returns the md5 of the remote file at path, '-' if path exists but isn't a
+    regular file, or None if it doesn't exist. path should be absolute.
+    """
+    return file_checksums(path)[path]
+
+
+def file_checksums(*paths):
+    """
+    Like file_checksum, for several paths at once: those that aren't known
+    yet are looked up in a single round trip. Returns a dict of path -> md5.
+    """
+    files = get('files')
+    unknown = [p for p in paths if p not in files]
+    if unknown:
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = sudo(_checksums_command(unknown))
+        files.update(dict([(p, None) for p in unknown]))
+        files.update(_parse_checksums(output.splitlines()))
+    return dict([(p, files[p]) for p in paths])
+
+
+def file_exists(path):
+    return file_checksum(path) is not None
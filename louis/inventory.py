@@ -0,0 +1,214 @@
+"""
+The hosts louis knows about, with their attributes, groups and tags.
+
+Hosts come from louisconf.HOSTS, whose entries are (ip, name) pairs or
+(ip, name, words) triples, and from the file at louisconf.INVENTORY_FILE if
+there is one, which lists a host per line:
+
+    # ip        name   attributes, groups and tags
+    [web]
+    10.0.2.11   web1   dc=2 size=large canary
+    10.0.2.12   web2   dc=2 group=cron
+
+A [section] line puts the hosts that follow it in that group, and so does a
+group= word. Any other word with an = in it is an attribute, and a word
+without one is a tag. A host listed more than once gets the attributes,
+groups and tags of every listing. The words of a louisconf.HOSTS entry (a
+string or a list) are those that follow the name on a line of the file.
+
+Everything is read the first time it's needed, and hosts are indexed by name,
+IP, attribute, group and tag, so selecting them (see select) looks up each
+term rather than going through every host.
+"""
+from __future__ import with_statement
+
+import re
+from fnmatch import fnmatch
+
+from fabric.api import abort
+
+from louis import conf
+from louis.utils import get_arg
+
+_hosts = None
+_index = None
+
+
+def _new_host(ip, name):
+    return {'ip': ip, 'name': name, 'attributes': {}, 'groups': [],
+            'tags': []}
+
+
+def _add_words(host, words, group=None):
+    if group and group not in host['groups']:
+        host['groups'].append(group)
+    for word in words:
+        key, sep, value = word.partition('=')
+        if not sep:
+            if word not in host['tags']:
+                host['tags'].append(word)
+        elif key == 'group':
+            if value not in host['groups']:
+                host['groups'].append(value)
+        else:
+            host['attributes'][key] = value
+
+
+def parse(lines, source='inventory', hosts=None):
+    """
+    Returns the hosts listed in lines, in the format described above, as a
+    list of dicts with ip, name, attributes, groups and tags. Hosts already
+    in hosts, if given, get what lines add to them, and the rest are appended
+    to it.
+    """
+    if hosts is None:
+        hosts = []
+    by_name = dict([(h['name'], h) for h in hosts])
+    group = None
+    for number, line in enumerate(lines):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        if words[0].startswith('['):
+            group = words[0].strip('[]')
+            continue
+        if len(words) < 2:
+            abort('%s, line %s: expected an IP and a name.' %
+                  (source, number + 1))
+        ip, name = words[:2]
+        host = by_name.get(name)
+        if host is None:
+            host = by_name[name] = _new_host(ip, name)
+            hosts.append(host)
+        _add_words(host, words[2:], group)
+    return hosts
+
+
+def _build_index(hosts):
+    # key -> value -> positions of the hosts that have it
+    index = {}
+
+    def add(key, value, position):
+        index.setdefault(key, {}).setdefault(value, []).append(position)
+    for position, host in enumerate(hosts):
+        add('name', host['name'], position)
+        add('ip', host['ip'], position)
+        for key, value in host['attributes'].items():
+            add(key, value, position)
+        for group in host['groups']:
+            add('group', group, position)
+        for tag in host['tags']:
+            add('tag', tag, position)
+    return index
+
+
+def load(path=None):
+    """
+    Reads louisconf.HOSTS and the inventory file at path
+    (louisconf.INVENTORY_FILE), and indexes the hosts in them.
+    """
+    global _hosts, _index
+    lines = []
+    for entry in conf.HOSTS:
+        words = len(entry) > 2 and entry[2] or ''
+        if not isinstance(words, basestring):
+            words = ' '.join(words)
+        lines.append('%s %s %s' % (entry[0], entry[1], words))
+    hosts = parse(lines, 'louisconf.HOSTS')
+    path = get_arg(path, 'INVENTORY_FILE', None)
+    if path:
+        with open(path) as inventory_file:
+            parse(inventory_file, path, hosts)
+    _hosts = hosts
+    _index = _build_index(hosts)
+    return _hosts
+
+
+def reset():
+    global _hosts, _index
+    _hosts = _index = None
+
+
+def hosts():
+    """
+    Returns every host, as dicts with ip, name, attributes, groups and tags,
+    in the order they're listed in.
+    """
+    if _hosts is None:
+        load()
+    return _hosts
+
+
+def find(name):
+    """
+    Returns the host called name, or whose IP is name, or None.
+    """
+    hosts()
+    for key in ('name', 'ip'):
+        positions = _index.get(key, {}).get(name)
+        if positions:
+            return _hosts[positions[0]]
+    return None
+
+
+def _is_pattern(value):
+    return re.search(r'[*?[]', value) is not None
+
+
+def _term_positions(term):
+    negate = False
+    if '!=' in term:
+        key, value = term.split('!=', 1)
+        negate = True
+    elif '=' in term:
+        key, value = term.split('=', 1)
+    elif term == 'all':
+        return set(range(len(_hosts)))
+    else:
+        key, value = 'name', term
+    values = _index.get(key.strip(), {})
+    value = value.strip()
+    if _is_pattern(value):
+        positions = set()
+        for candidate, found in values.items():
+            if fnmatch(candidate, value):
+                positions.update(found)
+    else:
+        positions = set(values.get(value, []))
+    if negate:
+        return set(range(len(_hosts))) - positions
+    return positions
+
+
+def select(selector='all'):
+    """
+    Returns the hosts matched by selector, in the order they're listed in.
+
+    A selector is a ;-separated list of alternatives, and matches the hosts
+    any of them matches. An alternative is a list of terms separated by , or
+    & (on fab's command line, where , separates arguments, use & or \\,) and
+    matches the hosts all of them match. A term is one of
+
+        all             every host
+        web1            the host called web1
+        role=web        hosts whose role attribute is web
+        dc!=2           hosts whose dc attribute isn't 2
+        group=web       hosts in the web group
+        tag=canary      hosts tagged canary
+        ip=10.0.2.11    the host with that IP
+
+    and values can be shell-style patterns, e.g. web* or name=web*.
+    """
+    hosts()
+    positions = set()
+    for alternative in selector.split(';'):
+        terms = [t for t in re.split('[,&]', alternative) if t.strip()]
+        if not terms:
+            continue
+        matched = _term_positions(terms[0].strip())
+        for term in terms[1:]:
+            if not matched:
+                break
+            matched &= _term_positions(term.strip())
+        positions |= matched
+    return [_hosts[p] for p in sorted(positions)]
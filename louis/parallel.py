@@ -0,0 +1,413 @@
+"""
+Runs a louis command on many hosts at once.
+
+There are two backends. With 'processes' (the default) every host gets its own
+worker process, which is the safe way to run fabric commands side by side:
+fabric's env, output settings and connection cache are process globals. Each
+host's output is buffered and printed in one block when the host is done.
+
+With 'threads' every host runs in a thread of this process instead, which
+costs a thread stack and a few buffers per host rather than a whole python
+process, so that hundreds of hosts can be worked on at once. fabric's env and
+output dicts are made thread-local for that (see _make_thread_local), as
+well as for the threads fabric starts to read a command's output (see
+_ThreadHandler), so the command functions run unchanged, and their output is
+streamed line by line, prefixed with the host's name, as it's printed.
+
+Either way a host that takes longer than the timeout is given up on and
+counted as failed.
+"""
+from __future__ import with_statement
+
+import signal
+import sys
+import threading
+import time
+import traceback
+from Queue import Queue, Empty
+from StringIO import StringIO
+
+from fabric import operations
+from fabric import state
+from fabric.api import env
+from fabric.thread_handling import ThreadHandler
+from fabric.colors import green, red
+
+from louis import templates
+from louis import trace
+
+BACKENDS = ('processes', 'threads')
+
+_local = threading.local()
+
+
+class HostTimeout(Exception):
+    pass
+
+
+def _disconnect_all():
+    for key in state.connections.keys():
+        state.connections.close(key)
+
+
+def _disconnect_host(ip):
+    # keys look like user@host:port
+    for key in state.connections.keys():
+        if key.rsplit(':', 1)[0].split('@')[-1] == ip:
+            state.connections.close(key)
+
+
+def _use_host(name, ip, user):
+    env.hosts = [ip]
+    env.host = ip
+    env.host_string = ip
+    env.hostname = name
+    if user:
+        env.user = user
+    env.linewise = True
+    env.abort_on_prompts = True
+
+
+def _call(command, kwargs, buf):
+    """
+    Runs the louis command named command, and returns None if it succeeded or
+    else why it failed.
+    """
+    import louis.commands
+
+    try:
+        getattr(louis.commands, command)(**kwargs)
+    except KeyboardInterrupt:
+        raise
+    except HostTimeout:
+        return 'timed out'
+    except SystemExit:
+        # fabric's abort() prints the reason and then calls sys.exit(1)
+        error = 'aborted'
+        for line in buf.getvalue().splitlines():
+            if line.startswith('Fatal error:'):
+                error = line[len('Fatal error:'):].strip()
+        return error
+    except BaseException as e:
+        traceback.print_exc()
+        return str(e) or e.__class__.__name__
+
+
+def _result(name, ip, error, duration, output):
+    return {
+        'name': name,
+        'ip': ip,
+        'ok': error is None,
+        'error': error,
+        'duration': duration,
+        'output': output,
+    }
+
+
+def _alarm(signum, frame):
+    raise HostTimeout()
+
+
+def _run_on_host(job):
+    """
+    Process worker body: runs one command on one host with its output
+    buffered.
+    """
+    name, ip, command, kwargs, user, timeout = job
+    # connections inherited from the parent or left over from the previous
+    # host this worker ran are not ours to use
+    state.connections.clear()
+    # spans of the parent's command were forked along with it
+    trace.reset()
+    _use_host(name, ip, user)
+
+    buf = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = buf
+    start = time.time()
+    if timeout:
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.alarm(timeout)
+    try:
+        error = _call(command, kwargs, buf)
+    finally:
+        signal.alarm(0)
+        duration = time.time() - start
+        sys.stdout, sys.stderr = stdout, stderr
+        _disconnect_all()
+    if error == 'timed out':
+        error = 'timed out after %ss' % timeout
+    return _result(name, ip, error, duration, buf.getvalue())
+
+
+def _run_with_processes(jobs, pool_size):
+    from multiprocessing import Pool
+
+    pool = Pool(processes=max(1, min(pool_size, len(jobs))))
+    results = []
+    try:
+        for result in pool.imap_unordered(_run_on_host, jobs):
+            print_host_output(result)
+            results.append(result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+class _ThreadLocalDict(dict):
+    """
+    Mixed into the classes of fabric's env and output by _make_thread_local.
+    A thread that has called _localize reads and writes its own copy of the
+    contents, and every other thread the shared ones.
+    """
+
+
+def _thread_dict(obj):
+    return getattr(_local, 'dicts', {}).get(id(obj), obj)
+
+
+def _delegate(name):
+    method = getattr(dict, name)
+
+    def delegated(self, *args, **kwargs):
+        return method(_thread_dict(self), *args, **kwargs)
+    delegated.__name__ = name
+    return delegated
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+              '__iter__', '__len__', 'clear', 'copy', 'get', 'has_key',
+              'items', 'iteritems', 'iterkeys', 'itervalues', 'keys', 'pop',
+              'popitem', 'setdefault', 'update', 'values'):
+    setattr(_ThreadLocalDict, _name, _delegate(_name))
+del _name
+
+
+def _make_thread_local(obj):
+    """
+    Turns obj (env or output) into a _ThreadLocalDict in place, since fabric's
+    modules hold on to the object itself.
+    """
+    cls = obj.__class__
+    if not issubclass(cls, _ThreadLocalDict):
+        # after cls in the MRO, so that e.g. output's aliases still expand;
+        # and not with obj.__class__ =, which fabric's dicts take for a key
+        object.__setattr__(obj, '__class__',
+                           type(cls.__name__, (cls, _ThreadLocalDict), {}))
+
+
+def _localize():
+    """
+    Gives the current thread its own copy of env and output.
+    """
+    _local.dicts = dict([(id(obj), dict.copy(obj))
+                         for obj in (state.env, state.output)])
+
+
+class _ThreadHandler(ThreadHandler):
+    """
+    fabric's ThreadHandler, which starts the threads that read a remote
+    command's output, with those threads seeing the env, output and host of
+    the thread that ran the command rather than the shared ones.
+    """
+    def __init__(self, name, callable, *args, **kwargs):
+        dicts = getattr(_local, 'dicts', {})
+        host = getattr(_local, 'host', None)
+
+        def inheriting(*args, **kwargs):
+            _local.dicts = dicts
+            _local.host = host
+            return callable(*args, **kwargs)
+        ThreadHandler.__init__(self, name, inheriting, *args, **kwargs)
+
+
+class _ThreadOutput(object):
+    """
+    Stands in for sys.stdout and sys.stderr while threads run: what a host's
+    thread writes is kept in its buffer and printed a line at a time with the
+    host's name in front, and everything else goes to stream.
+    """
+    def __init__(self, stream, lock):
+        self.stream = stream
+        self.lock = lock
+
+    def write(self, text):
+        host = getattr(_local, 'host', None)
+        with self.lock:
+            if host is None:
+                return self.stream.write(text)
+            # under the lock too, as a host's stdout and stderr are written
+            # by threads of their own
+            host['buf'].write(text)
+            lines = (host['partial'] + text).split('\n')
+            host['partial'] = lines.pop()
+            for line in lines:
+                self.stream.write('[%s] %s\n' % (host['name'], line))
+
+    # print's bookkeeping of whether a space is due, which is per thread
+    softspace = property(lambda self: getattr(_local, 'softspace', 0),
+                         lambda self, value: setattr(_local, 'softspace',
+                                                     value))
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _check_cancelled():
+    cancel = getattr(_local, 'cancel', None)
+    if cancel is not None and cancel.is_set():
+        raise HostTimeout()
+
+
+# threads can't be stopped from outside, so those of hosts that timed out
+# stop at their next remote operation, even after run_on_hosts has returned
+trace.before_operation.append(_check_cancelled)
+
+
+def _run_in_thread(job, results, cancel):
+    name, ip, command, kwargs, user, timeout = job
+    _localize()
+    _local.cancel = cancel
+    buf = StringIO()
+    _local.host = {'name': name, 'buf': buf, 'partial': ''}
+    _use_host(name, ip, user)
+    start = time.time()
+    try:
+        error = _call(command, kwargs, buf)
+    finally:
+        if _local.host['partial']:
+            sys.stdout.write('\n')
+        _local.host = None
+        _disconnect_host(ip)
+    results.put(_result(name, ip, error, time.time() - start, buf.getvalue()))
+
+
+def _run_with_threads(jobs, pool_size, timeout):
+    _make_thread_local(state.env)
+    _make_thread_local(state.output)
+    operations.ThreadHandler = _ThreadHandler
+    lock = threading.Lock()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = _ThreadOutput(stdout, lock)
+    sys.stderr = _ThreadOutput(stderr, lock)
+    # the pool must not close one host's connection to make room for
+    # another's, nor take one that's been running a command for a while (its
+    # last use is when the command started) for an idle one
+    saved_max = getattr(state.connections, 'max_connections', None)
+    saved_idle = getattr(state.connections, 'idle_timeout', None)
+    if saved_max is not None:
+        state.connections.max_connections = max(saved_max, 2 * pool_size)
+        state.connections.idle_timeout = 0
+
+    pending = list(reversed(jobs))
+    running = {}
+    finished = Queue()
+    results = []
+    try:
+        while pending or running:
+            while pending and len(running) < pool_size:
+                job = pending.pop()
+                cancel = threading.Event()
+                thread = threading.Thread(target=_run_in_thread,
+                                          args=(job, finished, cancel))
+                thread.daemon = True
+                thread.start()
+                running[job[0]] = (job, time.time(), cancel)
+            wait = 1
+            if timeout:
+                wait = max(0.01, min([started + timeout for job, started, c
+                                      in running.values()]) - time.time())
+            try:
+                result = finished.get(timeout=wait)
+            except Empty:
+                result = None
+            if result is not None and result['name'] in running:
+                del running[result['name']]
+                _print_host_status(result, stdout, lock)
+                results.append(result)
+            for job, started, cancel in running.values():
+                if timeout and time.time() - started >= timeout:
+                    # the thread gives up at its next remote operation, and
+                    # its result is ignored
+                    name, ip = job[:2]
+                    del running[name]
+                    cancel.set()
+                    _disconnect_host(ip)
+                    result = _result(name, ip,
+                                     'timed out after %ss' % timeout,
+                                     time.time() - started, '')
+                    _print_host_status(result, stdout, lock)
+                    results.append(result)
+    finally:
+        # e.g. on ^C, stop the threads that are still running too
+        for job, started, cancel in running.values():
+            cancel.set()
+        sys.stdout, sys.stderr = stdout, stderr
+        if saved_max is not None:
+            state.connections.max_connections = saved_max
+            state.connections.idle_timeout = saved_idle
+    return results
+
+
+def run_on_hosts(command, hosts, kwargs=None, pool_size=10, user=None,
+                 backend='processes', timeout=None):
+    """
+    Runs the louis command named command on every (ip, name) pair in hosts,
+    pool_size hosts at a time, with the given backend (processes or threads,
+    see above). A host that isn't done in timeout seconds fails. Prints each
+    host's output as it goes and returns the list of per-host results.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend %s' % backend)
+    kwargs = kwargs or {}
+    timeout = timeout and int(timeout) or None
+    # index the deploy templates once here rather than in every worker
+    templates.index()
+    jobs = [(name, ip, command, kwargs, user, timeout) for ip, name in hosts]
+    if backend == 'threads':
+        return _run_with_threads(jobs, pool_size, timeout)
+    return _run_with_processes(jobs, pool_size)
+
+
+def print_host_output(result):
+    color = result['ok'] and green or red
+    print(color('----- [%(name)s] %(ip)s -----' % result))
+    for line in result['output'].splitlines():
+        print('[%s] %s' % (result['name'], line))
+
+
+def _print_host_status(result, stream, lock):
+    text = '----- [%s] %s %s in %.1fs -----' % (
+        result['name'], result['ip'],
+        result['ok'] and 'done' or 'FAILED: %s' % result['error'],
+        result['duration'])
+    with lock:
+        stream.write((result['ok'] and green or red)(text) + '\n')
+
+
+def print_summary(command, results, elapsed):
+    """
+    Prints a per-host success/failure/duration table for a fleet run.
+    """
+    print('')
+    print('Summary for %s:' % command)
+    width = max([len(r['name']) for r in results] + [4])
+    for r in sorted(results, key=lambda r: r['name']):
+        line = '  %s  %-15s  %6.1fs  ' % (r['name'].ljust(width), r['ip'],
+                                           r['duration'])
+        if r['ok']:
+            print(line + green('ok'))
+        else:
+            print(line + red('FAILED: %s' % r['error']))
+    failed = len([r for r in results if not r['ok']])
+    text = '%s succeeded, %s failed in %.1fs' % (len(results) - failed, failed,
+                                                  elapsed)
+    print(failed and red(text) or green(text))
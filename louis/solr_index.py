@@ -0,0 +1,156 @@
+"""
+Feeds documents to Solr. Uploaded and run on the host by build_solr_index.
+
+Reads one JSON object per line from stdin (a document, field name -> value or
+list of values), posts them to Solr's update handler in batches from several
+worker processes, and commits every so often. After each commit the number
+of documents committed so far is written to the checkpoint file, and a later
+run with the same checkpoint file skips that many documents of its input, so
+an interrupted build picks up where it left off as long as the export lists
+documents in the same order. The checkpoint is removed once everything is
+committed.
+
+    python manage.py export_solr_documents | \\
+        python solr_index.py http://localhost:8080/solr checkpoint
+
+This file has no dependencies beyond the standard library and runs on both
+python 2 and 3, since it runs with whatever python the project uses.
+"""
+import json
+import os
+import sys
+import time
+from itertools import islice
+from multiprocessing import Pool
+from optparse import OptionParser
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+def _field(name, value):
+    if isinstance(value, bool):
+        value = value and 'true' or 'false'
+    elif not isinstance(value, text_type):
+        value = text_type(value)
+    return '<field name=%s>%s</field>' % (quoteattr(name), escape(value))
+
+
+def to_xml(documents):
+    """
+    Renders documents as a Solr XML <add> message.
+    """
+    parts = ['<add>']
+    for document in documents:
+        parts.append('<doc>')
+        for name, values in sorted(document.items()):
+            if not isinstance(values, list):
+                values = [values]
+            parts.extend([_field(name, value) for value in values
+                          if value is not None])
+        parts.append('</doc>')
+    parts.append('</add>')
+    return ''.join(parts).encode('utf-8')
+
+
+def post(url, body):
+    request = Request(url.rstrip('/') + '/update', body,
+                      {'Content-Type': 'text/xml; charset=utf-8'})
+    response = urlopen(request, timeout=300)
+    response.read()
+    return response.getcode()
+
+
+def _post_batch(job):
+    url, lines = job
+    try:
+        post(url, to_xml([json.loads(line) for line in lines if line.strip()]))
+    except Exception as e:
+        # HTTPErrors can't be pickled back to the parent process
+        raise RuntimeError('Posting to %s failed: %s' % (url, e))
+    return len(lines)
+
+
+def read_checkpoint(path):
+    try:
+        return int(open(path).read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def write_checkpoint(path, count):
+    tmp = path + '.tmp'
+    open(tmp, 'w').write('%s\n' % count)
+    os.rename(tmp, path)
+
+
+def batches(lines, batch_size):
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def report(label, count, start):
+    elapsed = max(time.time() - start, 0.001)
+    sys.stderr.write('%s %s documents indexed in %.1fs (%.1f docs/sec)\n' %
+                     (label, count, elapsed, count / elapsed))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog SOLR_URL CHECKPOINT_FILE < documents')
+    parser.add_option('-b', '--batch-size', type='int', default=500)
+    parser.add_option('-w', '--workers', type='int', default=4)
+    parser.add_option('-c', '--commit-interval', type='float', default=60,
+                      help='seconds between commits')
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error('SOLR_URL and CHECKPOINT_FILE are required')
+    url, checkpoint_path = args
+
+    skip = read_checkpoint(checkpoint_path)
+    lines = iter(sys.stdin)
+    if skip:
+        sys.stderr.write('Resuming after %s committed documents\n' % skip)
+        for line in islice(lines, skip):
+            pass
+
+    indexed = 0
+    start = last_commit = time.time()
+    pool = Pool(options.workers)
+    try:
+        jobs = ((url, batch) for batch in batches(lines, options.batch_size))
+        # imap hands results back in input order, so once a batch is back
+        # every document before it has been posted too
+        for count in pool.imap(_post_batch, jobs):
+            indexed += count
+            if time.time() - last_commit >= options.commit_interval:
+                post(url, b'<commit/>')
+                write_checkpoint(checkpoint_path, skip + indexed)
+                last_commit = time.time()
+                report('Committed %s documents so far,' % (skip + indexed),
+                       indexed, start)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    post(url, b'<commit/>')
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    report('Done:', indexed, start)
+
+
+if __name__ == '__main__':
+    main()
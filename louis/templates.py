@@ -0,0 +1,81 @@
+"""
+Local deploy templates, indexed once and rendered once per run.
+
+The deployer's tree is walked the first time a template is asked for, and a
+template rendered with a given context is kept, so deploying the same project
+to many hosts looks up and renders each file just once. Rendered files are
+only uploaded to hosts whose copy has a different checksum.
+"""
+from __future__ import with_statement
+
+import hashlib
+import os
+from StringIO import StringIO
+
+from fabric.api import put, abort
+
+from louis import facts
+from louis.utils import get_arg
+
+# directories never searched for templates
+SKIP_DIRS = ['.git', '.hg', '.svn', '.louis-bundles']
+
+_index = None
+_renders = {}
+
+
+def index(root=None):
+    """
+    Returns a dict of template file name -> local path, walking root
+    (louisconf.TEMPLATE_ROOT or the current directory) the first time it's
+    called. Only files named template.* are indexed; for a name found more
+    than once the first one found wins, as with the find it replaces.
+    """
+    global _index
+    if _index is None:
+        root = get_arg(root, 'TEMPLATE_ROOT', '.')
+        _index = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted([d for d in dirnames if d not in SKIP_DIRS])
+            for filename in sorted(filenames):
+                if filename.startswith('template.'):
+                    _index.setdefault(filename, os.path.join(dirpath, filename))
+    return _index
+
+
+def find(name):
+    """
+    Returns the local path of the template called name.
+    """
+    path = index().get(name)
+    if path is None:
+        abort('No %s template found.' % name)
+    return path
+
+
+def render(name, context):
+    """
+    Returns the template called name rendered with context, the way
+    files.upload_template does it.
+    """
+    key = (name, tuple(sorted(context.items())))
+    if key not in _renders:
+        _renders[key] = open(find(name)).read() % context
+    return _renders[key]
+
+
+def upload(name, destination, context, use_sudo=False, text=None):
+    """
+    Renders the template called name and uploads it to destination on the
+    current host, unless the file there is already the same. Returns whether
+    it was uploaded. See facts.file_checksums to look up several destinations
+    in one go beforehand. If text is given, it's uploaded instead of the
+    rendered template, e.g. after some per-host changes to it.
+    """
+    if text is None:
+        text = render(name, context)
+    if facts.file_checksum(destination) == hashlib.md5(text).hexdigest():
+        return False
+    put(StringIO(text), destination, use_sudo=use_sudo)
+    facts.forget_files(destination)
+    return True
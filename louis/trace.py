@@ -0,0 +1,240 @@
+"""
+Timing of louis commands, the steps inside them and every remote operation.
+
+Once enabled (with louisconf.TRACE or by running the trace command first,
+e.g. fab trace update_project), every louis command, every remote
+run/sudo/put/get and every step of a RemoteScript is recorded as a span with
+its duration, exit code and the bytes it moved. When the outermost command
+returns, the spans are written to a JSON file in louisconf.TRACE_DIR
+(traces/ by default) and the slowest of them are printed.
+
+The hooks are installed when louis.commands is imported and cost next to
+nothing while tracing is off.
+"""
+from __future__ import with_statement
+
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import fabric.api
+import fabric.main
+from fabric.api import env
+
+from louis import conf
+from louis.utils import get_arg
+
+OPERATIONS = ('run', 'sudo', 'put', 'get', 'local')
+# RemoteScript bookkeeping, left out of span names
+SCRIPT_LINES = ('rc=0; printf', 'rc=$?', '[ $rc')
+
+enabled = bool(getattr(conf, 'TRACE', False))
+# called before every remote operation, traced or not; louis.parallel uses
+# this to stop the threads of hosts that timed out
+before_operation = []
+# the spans recorded, and the stack of open ones, are per thread: the host
+# threads of louis.parallel each trace their host on their own
+_local = threading.local()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def _current():
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+        _local.stack = []
+    return _local
+
+
+def reset():
+    """
+    Forgets all spans, e.g. in a worker process forked in the middle of one.
+    """
+    _local.spans = []
+    _local.stack = []
+
+
+def _open(name, kind, attrs):
+    current = _current()
+    span = {
+        'id': len(current.spans),
+        'parent': current.stack[-1]['id'] if current.stack else None,
+        'name': name,
+        'kind': kind,
+        'host': env.host_string,
+        'start': time.time(),
+        'duration': None,
+        'exit_code': None,
+        'bytes': None,
+    }
+    span.update(attrs)
+    current.spans.append(span)
+    current.stack.append(span)
+    return span
+
+
+def _close(span, failed):
+    span['duration'] = time.time() - span['start']
+    if failed and span['exit_code'] is None:
+        span['exit_code'] = 1
+    stack = _current().stack
+    stack.remove(span)
+    if not stack:
+        report()
+
+
+@contextmanager
+def span(name, kind='step', **attrs):
+    """
+    Records what runs inside the with block as a span called name, and
+    yields it (a dict) so that exit_code and bytes can be filled in.
+
+        with trace.span('pip'):
+            ...
+    """
+    if not enabled:
+        yield {}
+        return
+    current = _open(name, kind, attrs)
+    failed = True
+    try:
+        yield current
+        failed = False
+    finally:
+        _close(current, failed)
+
+
+def record(name, kind, start, duration, **attrs):
+    """
+    Adds a span that was timed elsewhere, e.g. on the remote host.
+    """
+    if not enabled:
+        return
+    current = _open(name, kind, attrs)
+    current['start'] = start
+    current['duration'] = duration
+    _current().stack.remove(current)
+
+
+def _size(path):
+    if hasattr(path, 'getvalue'):
+        return len(path.getvalue())
+    if isinstance(path, basestring) and os.path.isfile(path):
+        return os.path.getsize(path)
+    return None
+
+
+def _trace_operation(name, fxn):
+    @functools.wraps(fxn)
+    def traced(*args, **kwargs):
+        for hook in before_operation:
+            hook()
+        if not enabled:
+            return fxn(*args, **kwargs)
+        target = args and args[0] or kwargs.get('command') or \
+            kwargs.get('local_path') or kwargs.get('remote_path') or ''
+        label = target
+        if not isinstance(label, basestring):
+            label = 'file object'
+        label = ([l for l in label.strip().splitlines()
+                  if not l.startswith(SCRIPT_LINES)] or [''])[0][:120]
+        with span('%s %s' % (name, label), 'remote') as current:
+            if name == 'put':
+                current['bytes'] = _size(target)
+            result = fxn(*args, **kwargs)
+            if name == 'get':
+                current['bytes'] = sum([_size(p) or 0 for p in result])
+            elif name != 'put':
+                current['exit_code'] = getattr(result, 'return_code', None)
+                current['bytes'] = len(result or '')
+            return result
+    traced.louis_traced = True
+    return traced
+
+
+def untraced(fxn):
+    """
+    Keeps the command fxn out of traces, e.g. one that only picks the hosts
+    for the commands after it and would otherwise get a trace file of its own.
+    """
+    fxn.louis_traced = True
+    return fxn
+
+
+def _trace_command(fxn):
+    @functools.wraps(fxn)
+    def traced(*args, **kwargs):
+        if not enabled:
+            return fxn(*args, **kwargs)
+        with span(fxn.__name__, 'task'):
+            return fxn(*args, **kwargs)
+    traced.louis_traced = True
+    return traced
+
+
+def install():
+    """
+    Wraps fabric's remote operations wherever louis modules imported them,
+    and every command defined in louis.commands and its submodules.
+    """
+    operations = dict([(name, getattr(fabric.api, name))
+                       for name in OPERATIONS])
+    traced_operations = dict([(name, _trace_operation(name, fxn))
+                              for name, fxn in operations.items()])
+    # fab lists every public callable in louis.commands as a task, except
+    # for fabric's own operations; the wrappers have to count as those
+    fabric.main._internals.extend(traced_operations.values())
+    modules = [m for name, m in sys.modules.items()
+               if m is not None and name.startswith('louis')]
+    commands = {}
+    for module in modules:
+        for name, value in vars(module).items():
+            if name in operations and operations[name] is value:
+                setattr(module, name, traced_operations[name])
+            elif callable(value) and not name.startswith('_') and \
+                    getattr(value, '__module__', '').startswith(
+                        'louis.commands') and \
+                    not getattr(value, 'louis_traced', False) and \
+                    not isinstance(value, type):
+                if value not in commands:
+                    commands[value] = _trace_command(value)
+                setattr(module, name, commands[value])
+
+
+def report():
+    """
+    Writes the spans recorded so far to a JSON file and prints the slowest
+    steps and remote commands.
+    """
+    import json
+
+    spans = _current().spans
+    if not spans:
+        return
+    root = spans[0]
+    trace_dir = get_arg(None, 'TRACE_DIR', 'traces')
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    path = os.path.join(trace_dir, '%s-%s%s.json' % (
+        datetime.fromtimestamp(root['start']).strftime('%Y%m%d%H%M%S'),
+        root['name'], root['host'] and '-%s' % root['host'] or ''))
+    with open(path, 'w') as trace_file:
+        json.dump({'spans': spans}, trace_file, indent=1)
+
+    top = int(get_arg(None, 'TRACE_TOP', 10))
+    slowest = sorted([s for s in spans if s['kind'] != 'task'],
+                     key=lambda s: -(s['duration'] or 0))[:top]
+    print('%s took %.2fs; slowest steps:' % (root['name'], root['duration']))
+    for s in slowest:
+        print('  %7.2fs  %-6s %s%s' % (
+            s['duration'] or 0, s['kind'], s['name'][:90],
+            s['exit_code'] and ' (exit code %s)' % s['exit_code'] or ''))
+    print('Trace written to %s' % path)
+    reset()